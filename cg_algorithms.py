@@ -1,5 +1,10 @@
+import collections
+import functools
 import string
 import math
+import threading
+
+import numpy as np
 
 
 class MetaGraphic:  # base class of all graphic classes
@@ -7,104 +12,358 @@ class MetaGraphic:  # base class of all graphic classes
         self.algorithm = algorithm
         self.points = points
         self.color = color
+        # every change of the graphic bumps version, the cached raster is valid while rasterVersion matches it
+        self.version = 0
+        self.raster = None
+        self.rasterVersion = -1
+        # box (x0, y0, x1, y1) pixels are drawn for, pixels outside it may be left out, None draws all
+        self.viewport = None
+        # (points, bounding box worked out from them), points are a new list whenever they change
+        self.box = None
+
+    @property
+    def points(self):
+        """
+        control points with the accumulated transform applied, rounded half up to integers
+        transforms only fold into matrix and offset, points are worked out once when they are needed
+        integral translations add to offset after rounding, so they move the rounded points rigidly
+        """
+        if self.transformedPoints is None:
+            points = self.controlPoints @ self.matrix[:2, :2].T + self.matrix[:2, 2]
+            points = np.floor(points + 0.5).astype(np.int64) + self.offset
+            self.transformedPoints = [tuple(point) for point in points.tolist()]
+        return self.transformedPoints
+
+    @points.setter
+    def points(self, points):
+        """ replace control points, dropping the accumulated transform """
+        self.controlPoints = np.array(points, np.float64).reshape(-1, 2)
+        # shared read-only arrays, transforms replace them rather than changing them
+        self.matrix = identityMatrix
+        self.offset = zeroOffset
+        # without a transform the rounded points are known at once, cheaper in Python than in numpy for a few
+        self.transformedPoints = [(math.floor(x + 0.5), math.floor(y + 0.5)) for x, y in self.controlPoints.tolist()]
+
+    def transform(self, matrix):
+        """ fold a 3x3 affine matrix into the accumulated transform, after the integral translation so far """
+        self.matrix = matrix @ translationMatrix(self.offset) @ self.matrix
+        self.offset = zeroOffset
+        self.transformedPoints = None
+        self.invalidate()
+
+    def __getstate__(self):
+        # the cached raster isn't worth pickling, it is drawn again on the other side when needed
+        state = self.__dict__.copy()
+        state["raster"] = None
+        state["rasterVersion"] = -1
+        return state
 
     def getColor(self):
         return self.color
 
-    # each subclass must overwrite draw method
+    # each subclass must overwrite draw method, which returns pixels as an (N, 2) integer array
     def draw(self):
         raise Exception("this graphic type haven't defined a draw method")
 
+    def rasterize(self):
+        """ return pixels of the graphic, drawing it only if it has changed since the last call """
+        if self.rasterVersion != self.version:
+            self.raster = toPixelArray([]) if self.isCulled() else self.draw()
+            self.rasterVersion = self.version
+        return self.raster
+
+    def isCulled(self):
+        """ whether the bounding box of the graphic misses viewport, so it has nothing to draw """
+        if self.viewport is None:
+            return False
+        box = self.getBoundingBox()
+        return box is None or not (box[0] < self.viewport[2] and self.viewport[0] < box[2]
+                                   and box[1] < self.viewport[3] and self.viewport[1] < box[3])
+
+    def isInsideViewport(self):
+        """ whether the bounding box of the graphic lies inside viewport, so no pixel is left out of the raster """
+        if self.viewport is None:
+            return True
+        box = self.getBoundingBox()
+        return box is not None and self.viewport[0] <= box[0] and self.viewport[1] <= box[1] \
+            and box[2] <= self.viewport[2] and box[3] <= self.viewport[3]
+
+    def invalidate(self):
+        self.version += 1
+
+    def paint(self, bitmap, region):
+        """
+        draw the graphic on bitmap, only inside region (x0, y0, x1, y1)
+        return numbers of pixels produced by the graphic and written inside region
+        """
+        x0, y0, x1, y1 = region
+        pixels = self.rasterize()
+        xs, ys = pixels[:, 0], pixels[:, 1]
+        box = self.getBoundingBox()
+        if box is not None and x0 <= box[0] and y0 <= box[1] and box[2] <= x1 and box[3] <= y1:
+            # wholly inside, which is the common case of small graphics, so no pixel needs testing
+            bitmap[ys, xs] = self.getColor()
+            return len(pixels), len(pixels)
+        inside = (x0 <= xs) & (xs < x1) & (y0 <= ys) & (ys < y1)
+        bitmap[ys[inside], xs[inside]] = self.getColor()
+        return len(pixels), int(np.count_nonzero(inside))
+
+    def isNear(self, x, y, tolerance):
+        """ whether the graphic has a pixel within tolerance of (x, y) """
+        pixels = self.rasterize()
+        return bool((np.abs(pixels - (x, y)).max(axis=1, initial=0) <= tolerance).any())
+
+    def getBoundingBox(self):
+        """
+        return a box (x0, y0, x1, y1) with exclusive x1 and y1 holding every pixel the graphic draws
+        it is worked out from points alone, so it is known without drawing the graphic
+        """
+        points = self.points
+        if self.box is not None and self.box[0] is points:
+            return self.box[1]
+        xs = [point[0] for point in points]
+        ys = [point[1] for point in points]
+        box = min(xs) - 1, min(ys) - 1, max(xs) + 2, max(ys) + 2
+        self.box = (points, box)
+        return box
+
+    # whether translating the graphic moves its pixels exactly by the displacement, subclasses may overwrite it
+    def canShiftRaster(self, displacement):
+        return False
+
     def translate(self, displacement):
-        self.points = translatePoints(self.points, displacement)
+        if not all(float(d).is_integer() for d in displacement):
+            self.transform(translationMatrix(displacement))
+            return
+        # pixels left out by viewport would be missing from the shifted raster
+        shiftable = self.rasterVersion == self.version and self.canShiftRaster(displacement) \
+            and self.isInsideViewport()
+        self.offset = self.offset + np.array(displacement, np.int64)
+        self.transformedPoints = None
+        self.invalidate()
+        if shiftable:
+            # shift the cached pixels instead of drawing again
+            self.raster = self.raster + np.array(displacement, np.int64)
+            self.rasterVersion = self.version
 
     def rotate(self, center, degree):
-        self.points = translatePoints(self.points, (-center[0], -center[1]))
-        self.points = rotatePoints(self.points, degree)
-        self.points = translatePoints(self.points, center)
+        self.transform(translationMatrix(center) @ rotationMatrix(degree)
+                       @ translationMatrix((-center[0], -center[1])))
 
     def scale(self, center, times):
-        self.points = translatePoints(self.points, (-center[0], -center[1]))
-        self.points = scalePoints(self.points, times)
-        self.points = translatePoints(self.points, center)
+        self.transform(translationMatrix(center) @ scalingMatrix(times)
+                       @ translationMatrix((-center[0], -center[1])))
 
     # only lines can be clipped
     def clip(self, algorithm, pointA, pointB):
         raise Exception("clipping a non-line graphic")
 
 
-def swapPointsXY(points):
+identityMatrix = np.identity(3)
+identityMatrix.flags.writeable = False
+zeroOffset = np.zeros(2, np.int64)
+zeroOffset.flags.writeable = False
+
+
+def isIntegralShift(points, displacement):
     """
-    swap x and y of all points in a point list
-    return a list after the operation
-    (x, y) -> (y, x)
+    check whether displacement is integral and points stay non-negative before and after being translated
+    an integral displacement moves rounded points exactly, see MetaGraphic.points, and int() truncates toward
+    zero, so only then graphics computed by int() move exactly with the displacement
     """
-    reversedPoints = []
+    if not all(float(d).is_integer() for d in displacement):
+        return False
     for point in points:
-        reversedPoints.append((point[1], point[0]))
-    return reversedPoints
+        for i in range(2):
+            if point[i] < 0 or point[i] + displacement[i] < 0:
+                return False
+    return True
 
 
-def flipPointsY(points):
+def toPixelArray(points):
     """
-    flip y of all points in a point list
-    return a list after the operation
-    (x, y) -> (x, -y)
+    convert a point list to an (N, 2) integer array
     """
-    flippedPoints = []
-    for point in points:
-        flippedPoints.append((point[0], -point[1]))
-    return flippedPoints
+    return np.array(points, np.int64).reshape(-1, 2)
 
 
-def flipPointsX(points):
+def translationMatrix(displacement):
     """
-    flip x of all points in a point list
-    return a list after the operation
-    (x, y) -> (-x, y)
+    affine matrix of (x, y) -> (x + dx, y + dy)
     """
-    flippedPoints = []
-    for point in points:
-        flippedPoints.append((-point[0], point[1]))
-    return flippedPoints
+    return np.array([[1, 0, displacement[0]],
+                     [0, 1, displacement[1]],
+                     [0, 0, 1]], np.float64)
+
+
+def rotationMatrix(degree):
+    """
+    affine matrix rotating clockwise, origin point as the center
+    """
+    radian = degree * math.pi / 180
+    cos, sin = math.cos(radian), math.sin(radian)
+    return np.array([[cos, -sin, 0],
+                     [sin, cos, 0],
+                     [0, 0, 1]], np.float64)
 
 
-def translatePoints(points, displacement):
+def scalingMatrix(times):
     """
-    translate all points in a point list
-    return a list after the operation
-    (x, y) -> (x + dx, y + dy)
+    affine matrix of (x, y) -> (x * times, y * times), origin point as the center
     """
-    translatedPoints = []
-    for i in range(0, len(points)):
-        translatedPoints.append((points[i][0] + displacement[0], points[i][1] + displacement[1]))
-    return translatedPoints
+    return np.array([[times, 0, 0],
+                     [0, times, 0],
+                     [0, 0, 1]], np.float64)
 
 
-def rotatePoints(points, degree):
+def prepareLines(starts, ends):
     """
-    rotate all points in a point list clockwise, origin point as the center
-    return a list after the operation
+    normalize many segments for rasterization at once
+    every segment is sampled along its major axis u, the other axis is v
+    return (swapped, start u, start v, du, dv) as arrays, where swapped marks segments whose major axis is y
+    and du >= 0 since each segment is generated from the end with smaller u
     """
-    rotatedPoints = []
-    radian = degree * math.pi / 180
-    for i in range(0, len(points)):
-        x, y = points[i][0], points[i][1]
-        rotatedPoints.append((int(x * math.cos(radian) - y * math.sin(radian)),
-                              int(x * math.sin(radian) + y * math.cos(radian))))
-    return rotatedPoints
+    starts = np.asarray(starts, np.int64).reshape(-1, 2)
+    ends = np.asarray(ends, np.int64).reshape(-1, 2)
+    swapped = np.abs(starts[:, 1] - ends[:, 1]) > np.abs(starts[:, 0] - ends[:, 0])
+    majorA = np.where(swapped, starts[:, 1], starts[:, 0])
+    minorA = np.where(swapped, starts[:, 0], starts[:, 1])
+    majorB = np.where(swapped, ends[:, 1], ends[:, 0])
+    minorB = np.where(swapped, ends[:, 0], ends[:, 1])
+    forward = majorA <= majorB
+    u = np.where(forward, majorA, majorB)
+    v = np.where(forward, minorA, minorB)
+    du = np.where(forward, majorB - majorA, majorA - majorB)
+    dv = np.where(forward, minorB - minorA, minorA - minorB)
+    return swapped, u, v, du, dv
+
+
+def expandSteps(counts):
+    """
+    generate step indices of many segments at once
+    return (segment index, step index within the segment) of every step
+    """
+    total = int(counts.sum())
+    segments = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    steps = np.arange(total, dtype=np.int64) - np.repeat(offsets, counts)
+    return segments, steps
 
 
-def scalePoints(points, times):
+def assemblePixels(swapped, us, vs):
+    """
+    turn (u, v) back to (x, y), swapping back the segments sampled by y
+    return an (N, 2) integer array
+    """
+    pixels = np.empty((len(us), 2), np.int64)
+    pixels[:, 0] = np.where(swapped, vs, us)
+    pixels[:, 1] = np.where(swapped, us, vs)
+    return pixels
+
+
+def divideTowardZero(numerator, denominator):
+    """ integer division truncating toward zero like int(), denominator must be positive """
+    return np.where(numerator < 0, -(-numerator // denominator), numerator // denominator)
+
+
+def clipSteps(swapped, u, v, du, dv, counts, viewport):
+    """
+    narrow the steps 0 <= k < counts of many normalized segments down to the ones which may be inside viewport
+    the k-th pixel of a segment is at u + k along the major axis and within 1 of v + k * dv / du along the other,
+    so the steps are clipped like Liang-Barsky does with the window, grown by 1 across the major axis
+    return (first step, step count) of every segment, no pixel inside viewport is left out
+    """
+    if viewport is None:
+        return np.zeros_like(counts), counts
+    x0, y0, x1, y1 = viewport
+    uLow, uHigh = np.where(swapped, y0, x0), np.where(swapped, y1, x1) - 1
+    vLow, vHigh = np.where(swapped, x0, y0) - 1, np.where(swapped, x1, y1)
+    firsts = np.maximum(uLow - u, 0)
+    lasts = np.minimum(uHigh - u, counts - 1)
+
+    # k * dv / du must stay in [vLow - v, vHigh - v], bounds are swapped going downwards
+    lows, highs = (vLow - v) * du, (vHigh - v) * du
+    rising, falling = dv > 0, dv < 0
+    slope = np.where(dv != 0, np.abs(dv), 1)
+    firsts = np.where(rising, np.maximum(firsts, -(-lows // slope)), firsts)
+    lasts = np.where(rising, np.minimum(lasts, highs // slope), lasts)
+    firsts = np.where(falling, np.maximum(firsts, -(highs // slope)), firsts)
+    lasts = np.where(falling, np.minimum(lasts, (-lows) // slope), lasts)
+    # a level segment stays on its row
+    level = (dv == 0) & ((v <= vLow) | (v >= vHigh))
+    return firsts, np.where(level, 0, np.maximum(lasts - firsts + 1, 0))
+
+
+def rasterizeLinesByDDA(starts, ends, viewport=None, returnCounts=False):
     """
-    scale all points in a point list clockwise, origin point as the center
-    return a list after the operation
-    (x, y) -> (x * times, y * times)
+    rasterize many segments by DDA at once
+    starts and ends are sequences of points, the k-th segment goes from starts[k] to ends[k]
+    return an (N, 2) integer array of the pixels of all segments, segment by segment,
+    and with returnCounts the number of pixels of each segment as well
+    y is stepped in fixed point: the k-th pixel takes int(v + k * dv / du) computed by integer division
+    with a viewport (x0, y0, x1, y1), steps which can't be inside it are skipped
     """
-    scaledPoints = []
-    for i in range(0, len(points)):
-        scaledPoints.append((int(points[i][0] * times), int(points[i][1] * times)))
-    return scaledPoints
+    swapped, u, v, du, dv = prepareLines(starts, ends)
+    # a degenerate segment (du == 0) is a single point
+    firsts, counts = clipSteps(swapped, u, v, du, dv, du + 1, viewport)
+    segments, steps = expandSteps(counts)
+    steps += firsts[segments]
+    du = np.maximum(du, 1)[segments]
+    vs = divideTowardZero(v[segments] * du + steps * dv[segments], du)
+    pixels = assemblePixels(swapped[segments], u[segments] + steps, vs)
+    return (pixels, counts) if returnCounts else pixels
+
+
+def rasterizeLinesByBresenham(starts, ends, viewport=None, returnCounts=False):
+    """
+    rasterize many segments by Bresenham at once
+    starts and ends are sequences of points, the k-th segment goes from starts[k] to ends[k]
+    return an (N, 2) integer array of the pixels of all segments, segment by segment,
+    and with returnCounts the number of pixels of each segment as well
+    the decider of the k-th step is positive exactly when k * dv / du rounds half down to one more,
+    so every pixel is computed directly instead of walking the decider
+    with a viewport (x0, y0, x1, y1), steps which can't be inside it are skipped
+    """
+    swapped, u, v, du, dv = prepareLines(starts, ends)
+    # horizontal segments stop before the end and degenerate ones draw nothing, same as the walking version
+    firsts, counts = clipSteps(swapped, u, v, du, dv, np.where(dv == 0, du, du + 1), viewport)
+    segments, steps = expandSteps(counts)
+    steps += firsts[segments]
+    # flip v if needed to ensure gradient >= 0
+    flipped = dv < 0
+    dv = np.abs(dv)
+    du, dv = du[segments], dv[segments]
+    offsets = (2 * steps * dv + du - 1) // np.maximum(2 * du, 1)
+    vs = np.where(flipped[segments], v[segments] - offsets, v[segments] + offsets)
+    pixels = assemblePixels(swapped[segments], u[segments] + steps, vs)
+    return (pixels, counts) if returnCounts else pixels
+
+
+def rasterizeLines(lines):
+    """
+    draw rasters of many Line graphics, one batch for each algorithm and viewport, instead of one call each
+    lines whose raster is up to date are skipped, the others get the same raster rasterize would draw
+    """
+    batches = {}
+    for line in lines:
+        if line.rasterVersion == line.version or line.algorithm not in lineRasterizers:
+            continue
+        if line.clippedAll or line.isCulled():
+            line.raster = toPixelArray([])
+            line.rasterVersion = line.version
+            continue
+        batches.setdefault((line.algorithm, line.viewport), []).append(line)
+
+    for (algorithm, viewport), batch in batches.items():
+        starts = [line.points[0] for line in batch]
+        ends = [line.points[1] for line in batch]
+        pixels, counts = lineRasterizers[algorithm](starts, ends, viewport, returnCounts=True)
+        for line, raster in zip(batch, np.split(pixels, np.cumsum(counts)[:-1])):
+            line.raster = raster
+            line.rasterVersion = line.version
+
+
+lineRasterizers = {"DDA": rasterizeLinesByDDA, "Bresenham": rasterizeLinesByBresenham}
 
 
 class Line(MetaGraphic):
@@ -114,9 +373,9 @@ class Line(MetaGraphic):
 
     def draw(self):
         if self.clippedAll:
-            return []
+            return toPixelArray([])
 
-        result = []
+        result = toPixelArray([])
         if self.algorithm == "DDA":
             result = self.drawByDDA()
         elif self.algorithm == "Bresenham":
@@ -124,88 +383,21 @@ class Line(MetaGraphic):
         return result
 
     def drawByDDA(self):
-        result = []
-        points = self.points
-        if points[0] == points[1]:
-            result.append(points[0])
-            return result
-
-        # swap x and y if needed to ensure to be sampled by x
-        reverseFlag = math.fabs(self.points[0][1] - self.points[1][1]) - math.fabs(
-            self.points[0][0] - self.points[1][0]) > 0
-        if reverseFlag:
-            points = swapPointsXY(self.points)
-        # ensure generating along +x
-        if points[0][0] <= points[1][0]:
-            start = points[0]
-            end = points[1]
-        else:
-            start = points[1]
-            end = points[0]
-
-        # main algorithm
-        gradient = float(end[1] - start[1]) / (end[0] - start[0])
-        x, y = start[0], start[1]
-        while x <= end[0]:
-            result.append((int(x), int(y)))
-            x += 1
-            y += gradient
-
-        # swap back x and y if having swapped before
-        if reverseFlag:
-            result = swapPointsXY(result)
-
-        return result
+        return rasterizeLinesByDDA([self.points[0]], [self.points[1]], self.viewport)
 
     def drawByBresenham(self):
-        result = []
-        points = self.points
+        return rasterizeLinesByBresenham([self.points[0]], [self.points[1]], self.viewport)
 
-        # swap x and y if needed to ensure to be sampled by x
-        reverseFlag = math.fabs(self.points[0][1] - self.points[1][1]) - math.fabs(
-            self.points[0][0] - self.points[1][0]) > 0
-        if reverseFlag:
-            points = swapPointsXY(points)
-        # flip y if needed to ensure gradient >= 0
-        yFlippedFlag = (points[0][1] - points[1][1]) * (points[0][0] - points[1][0]) < 0
-        if yFlippedFlag:
-            points = flipPointsY(points)
-
-        # ensure generating along +x
-        if points[0][0] <= points[1][0]:
-            start = points[0]
-            end = points[1]
-        else:
-            start = points[1]
-            end = points[0]
-
-        dx = end[0] - start[0]
-        dy = end[1] - start[1]
-
-        # two corner cases, avoid obvious deviation at start
-        if dx == 0:
-            for y in range(start[1], end[1]):
-                result.append((start[0], y))
-        elif dy == 0:
-            for x in range(start[0], end[0]):
-                result.append((x, start[1]))
-        # main algorithm
-        else:
-            x, y = start[0], start[1]
-            decider = 2 * dy - dx
-            while x <= end[0]:
-                result.append((x, y))
-                x += 1
-                y += 1 if decider > 0 else 0
-                decider += 2 * dy - (2 * dx if decider > 0 else 0)
-
-        # flip back y if having flipped before
-        if yFlippedFlag:
-            result = flipPointsY(result)
-        # swap back x and y if having swapped before
-        if reverseFlag:
-            result = swapPointsXY(result)
-        return result
+    def getBoundingBox(self):
+        if self.clippedAll:
+            return None
+        return super().getBoundingBox()
+
+    def canShiftRaster(self, displacement):
+        # Bresenham only works on integers, DDA truncates like int()
+        if self.algorithm == "Bresenham":
+            return all(float(d).is_integer() for d in displacement)
+        return isIntegralShift(self.points, displacement)
 
     def clip(self, algorithm, pointA, pointB):
         if self.clippedAll:
@@ -214,6 +406,7 @@ class Line(MetaGraphic):
             self.clipByCohenSutherland(pointA, pointB)
         elif algorithm == "Liang-Barsky":
             self.clipByLiangBarsky(pointA, pointB)
+        self.invalidate()
 
     def clipByCohenSutherland(self, pointA, pointB):
         left, right = (pointA[0], pointB[0]) if pointA[0] <= pointB[0] else (pointB[0], pointA[0])
@@ -252,7 +445,7 @@ class Line(MetaGraphic):
                 elif getBinaryDigit(codeEnd, 3) == 1:
                     end = Line.getIntersection(start, end, up, 1)
 
-        self.points[0], self.points[1] = start, end
+        self.points = [start, end]
 
     @staticmethod
     def getIntersection(start, end, loc, isY):
@@ -276,82 +469,237 @@ class Line(MetaGraphic):
             return 0b10
 
     def clipByLiangBarsky(self, pointA, pointB):
-        left, right = (pointA[0], pointB[0]) if pointA[0] <= pointB[0] else (pointB[0], pointA[0])
-        bottom, up = (pointA[1], pointB[1]) if pointA[1] <= pointB[1] else (pointB[1], pointA[1])
-        start, end = self.points[0], self.points[1]
+        visible, starts, ends = clipLinesByLiangBarsky([self.points[0]], [self.points[1]], pointA, pointB)
+        self.setClipped(visible[0], tuple(starts[0].tolist()), tuple(ends[0].tolist()))
 
-        p = [start[0] - end[0], end[0] - start[0], start[1] - end[1], end[1] - start[1]]
-        q = [start[0] - left, right - start[0], start[1] - bottom, up - start[1]]
-
-        uIns = [0]
-        uOuts = [1]
-        for i in range(0, 4):
-            # check parallel
-            if p[i] == 0:
-                if q[i] < 0:
-                    # not visible
-                    self.clippedAll = True
-                    return
-                else:
-                    continue
-
-            # p[i] != 0
-            u = float(q[i] / p[i])
-            if p[i] < 0:
-                uIns.append(u)
-            else:
-                uOuts.append(u)
-
-        uIn = max(uIns)
-        uOut = min(uOuts)
-
-        if uIn > uOut:
-            # not visible
+    def setClipped(self, visible, start, end):
+        """ take the result of clipping, the clipped segment from start to end if visible """
+        if not visible:
             self.clippedAll = True
-            return
-
-        clippedStart = Line.getPointByU(uIn, start, end)
-        clippedEnd = Line.getPointByU(uOut, start, end)
+        else:
+            self.points = [start, end]
 
-        self.points[0], self.points[1] = clippedStart, clippedEnd
 
-    @staticmethod
-    def getPointByU(u, start, end):
-        """
-        according to parametric line equation:
-        x = x1 + u * (x2 - x1)
-        y = y1 + u * (y2 - y1)
-        get the point of the line by u
-        """
-        return int(start[0] + u * (end[0] - start[0])), int(start[1] + u * (end[1] - start[1]))
+def clipLinesByLiangBarsky(starts, ends, pointA, pointB):
+    """
+    clip many segments to the window with corners pointA and pointB by Liang-Barsky at once
+    the k-th segment goes from starts[k] to ends[k], clipped ends are truncated to integers like int()
+    return (visible, clipped starts, clipped ends), the ends of a segment are meaningless if it isn't visible
+    """
+    left, right = min(pointA[0], pointB[0]), max(pointA[0], pointB[0])
+    bottom, up = min(pointA[1], pointB[1]), max(pointA[1], pointB[1])
+    starts = np.asarray(starts, np.int64).reshape(-1, 2)
+    ends = np.asarray(ends, np.int64).reshape(-1, 2)
+    deltas = ends - starts
+
+    # one column for each window edge
+    p = np.stack([-deltas[:, 0], deltas[:, 0], -deltas[:, 1], deltas[:, 1]], axis=1)
+    q = np.stack([starts[:, 0] - left, right - starts[:, 0], starts[:, 1] - bottom, up - starts[:, 1]], axis=1)
+    # parallel to an edge and outside of it
+    visible = ~((p == 0) & (q < 0)).any(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        us = q / p
+    uIn = np.max(np.where(p < 0, us, 0), axis=1, initial=0)
+    uOut = np.min(np.where(p > 0, us, 1), axis=1, initial=1)
+    visible &= uIn <= uOut
+
+    clippedStarts = np.trunc(starts + uIn[:, np.newaxis] * deltas).astype(np.int64)
+    clippedEnds = np.trunc(starts + uOut[:, np.newaxis] * deltas).astype(np.int64)
+    return visible, clippedStarts, clippedEnds
 
 
 def getBinaryDigit(num, index):
     return num >> index & 0b1
 
 
+def fillPolygon(points, viewport=None):
+    """
+    scanline fill of a polygon with integer vertices by the even-odd rule
+    an edge is active on rows ymin <= y < ymax, so a vertex shared by two edges is crossed once, horizontal edges never
+    the active edge table of every row is worked out at once: crossings of all rows are sorted by (y, x),
+    and each row pairs them up into spans, each taking the pixels x with xl <= x <= xr
+    with a viewport (x0, y0, x1, y1) the polygon is clipped to it, only rows inside are scanned and spans are cut
+    at its sides, which fills the same pixels as clipping the polygon by Sutherland-Hodgman first
+    return spans as an (N, 3) integer array (y, x0, x1) with exclusive x1, sorted by y
+    """
+    ends = np.array(points, np.int64).reshape(-1, 2)
+    starts = np.roll(ends, 1, axis=0)
+    # orient every edge upwards, (xa, ya) is the end with smaller y
+    upward = starts[:, 1] <= ends[:, 1]
+    lows, highs = np.where(upward[:, np.newaxis], starts, ends), np.where(upward[:, np.newaxis], ends, starts)
+    edges = np.flatnonzero(highs[:, 1] > lows[:, 1])
+    xa, ya = lows[edges, 0], lows[edges, 1]
+    dx, dy = highs[edges, 0] - xa, highs[edges, 1] - ya
+
+    firsts, counts = np.zeros_like(dy), dy
+    if viewport is not None:
+        firsts = np.clip(viewport[1] - ya, 0, dy)
+        counts = np.clip(viewport[3] - ya, 0, dy) - firsts
+    segments, steps = expandSteps(counts)
+    steps += firsts[segments]
+    ys = ya[segments] + steps
+    # crossing x = xa + steps * dx / dy, kept as a numerator over dy to round it exactly
+    numerators = xa[segments] * dy[segments] + steps * dx[segments]
+    order = np.lexsort((numerators / dy[segments], ys))
+    ys, numerators, denominators = ys[order], numerators[order], dy[segments][order]
+
+    # every row has an even number of crossings, so pairs never straddle two rows
+    lefts = -(-numerators[0::2] // denominators[0::2])
+    rights = numerators[1::2] // denominators[1::2] + 1
+    if viewport is not None:
+        lefts, rights = np.maximum(lefts, viewport[0]), np.minimum(rights, viewport[2])
+    spans = np.stack([ys[0::2], lefts, rights], axis=1)
+    return spans[lefts < rights]
+
+
 class Polygon(MetaGraphic):
-    def __init__(self, algorithm, color, pointList):
+    def __init__(self, algorithm, color, pointList, filled=False):
         super().__init__(algorithm, color, pointList)
+        # a filled polygon paints its inside as well as its edges
+        self.filled = filled
+        self.spans = None
+        self.spansVersion = -1
 
     def draw(self):
-        lineList = []
-        last = self.points[len(self.points) - 1]
-        result = []
+        """ all edges are rasterized in one batch, pixels shared by neighbouring edges are kept once """
+        ends = np.array(self.points, np.int64).reshape(-1, 2)
+        starts = np.roll(ends, 1, axis=0)
+        pixels = toPixelArray([])
+        if self.algorithm == "DDA":
+            pixels = rasterizeLinesByDDA(starts, ends, self.viewport)
+        elif self.algorithm == "Bresenham":
+            pixels = rasterizeLinesByBresenham(starts, ends, self.viewport)
+        return np.unique(pixels, axis=0)
 
-        for point in self.points:
-            lineList.append(Line(self.algorithm, self.color, last, point))
-            last = point
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["spans"] = None
+        state["spansVersion"] = -1
+        return state
 
-        for line in lineList:
-            result += line.draw()
-        return result
+    def getSpans(self):
+        """
+        return horizontal spans inside the polygon by the even-odd rule as an (N, 3) integer array sorted by rows,
+        each row (y, x0, x1) covering pixels x0 <= x < x1, drawn only if the polygon has changed since the last call
+        """
+        if self.spansVersion != self.version:
+            self.spans = fillPolygon(self.points, self.viewport)
+            self.spansVersion = self.version
+        return self.spans
+
+    def paint(self, bitmap, region):
+        produced, written = super().paint(bitmap, region)
+        if not self.filled:
+            return produced, written
+        x0, y0, x1, y1 = region
+        spans = self.getSpans()
+        first, last = np.searchsorted(spans[:, 0], (y0, y1))
+        spans = spans[first:last]
+        starts, ends = np.maximum(spans[:, 1], x0), np.minimum(spans[:, 2], x1)
+        color = self.getColor()
+        for y, start, end in zip(spans[:, 0].tolist(), starts.tolist(), ends.tolist()):
+            if start < end:
+                bitmap[y, start:end] = color
+        produced += int((spans[:, 2] - spans[:, 1]).sum())
+        written += int(np.maximum(ends - starts, 0).sum())
+        return produced, written
+
+    def isNear(self, x, y, tolerance):
+        if super().isNear(x, y, tolerance):
+            return True
+        if not self.filled:
+            return False
+        spans = self.getSpans()
+        return bool(((np.abs(spans[:, 0] - y) <= tolerance) & (spans[:, 1] - tolerance <= x)
+                     & (x < spans[:, 2] + tolerance)).any())
+
+    def canShiftRaster(self, displacement):
+        # edges are drawn as lines
+        if self.algorithm == "Bresenham":
+            return all(float(d).is_integer() for d in displacement)
+        return isIntegralShift(self.points, displacement)
 
 
 class Rectangle(Polygon):
-    def __init__(self, algorith, color, pointA, pointB):
+    def __init__(self, algorith, color, pointA, pointB, filled=False):
         super().__init__(algorith, color,
-                         [pointA, (pointA[0], pointB[1]), pointB, (pointB[0], pointA[1])])
+                         [pointA, (pointA[0], pointB[1]), pointB, (pointB[0], pointA[1])], filled)
+
+
+class ArrayCache:
+    """
+    least recently used cache of read-only arrays bounded by their total bytes rather than their number
+    an array larger than maxBytes alone is returned without being kept
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.arrays = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """ return the array under key, computing it by compute() if it isn't kept """
+        with self.lock:
+            array = self.arrays.get(key)
+            if array is not None:
+                self.arrays.move_to_end(key)
+                return array
+        array = compute()
+        array.flags.writeable = False
+        if array.nbytes > self.maxBytes:
+            return array
+        with self.lock:
+            if key not in self.arrays:
+                self.arrays[key] = array
+                self.size += array.nbytes
+            while self.size > self.maxBytes:
+                _, dropped = self.arrays.popitem(last=False)
+                self.size -= dropped.nbytes
+        return array
+
+
+# quadrants are kept rather than whole outlines, a quarter of the memory for print-sized ellipses
+ellipseQuadrants = ArrayCache(64 << 20)
+
+
+def getEllipseOutline(width, height):
+    """
+    pixels of an ellipse with radii rx = width / 2 and ry = height / 2 centered at origin by the midpoint algorithm
+    return an (N, 2) integer array, assembled from the cached quadrant
+    """
+    quadrant = ellipseQuadrants.get((width, height), lambda: getEllipseQuadrant(width, height))
+    half = np.concatenate([quadrant, quadrant * (-1, 1)])
+    return np.concatenate([half, half * (1, -1)])
+
+
+def getEllipseQuadrant(width, height):
+    """
+    pixels of the quadrant with x >= 0 and y >= 0 of the ellipse drawn by getEllipseOutline
+    all deciders are 16 times their real value, which keeps them integers since rx and ry may be halves
+    """
+    rx2, ry2 = width * width, height * height  # 4 * rx ** 2 and 4 * ry ** 2
+    result = []
+
+    # first part
+    x, y = 0, height // 2
+    decider = 4 * ry2 - 2 * rx2 * height + rx2
+    while ry2 * x < rx2 * y:
+        result.append((x, y))
+        stepY = decider >= 0
+        x += 1
+        y -= 1 if stepY else 0
+        decider += 8 * ry2 * x + 4 * ry2 - (8 * rx2 * y if stepY else 0)
+    # second part
+    decider = ry2 * (2 * x + 1) ** 2 + 4 * rx2 * (y - 1) ** 2 - rx2 * ry2
+    while y >= 0:
+        result.append((x, y))
+        stepX = decider <= 0
+        y -= 1
+        x += 1 if stepX else 0
+        decider += 4 * rx2 - 8 * rx2 * y + (8 * ry2 * x if stepX else 0)
+
+    return toPixelArray(result)
 
 
 class Ellipse(MetaGraphic):
@@ -359,127 +707,195 @@ class Ellipse(MetaGraphic):
         super().__init__(algorithm, color, [pointA, pointB])
 
     def draw(self):
-        result = []
+        result = toPixelArray([])
         if self.algorithm == "Midpoint":
             result = self.drawByMidpoint()
         return result
 
     def drawByMidpoint(self):
-        result = []
         ellipseCenter = (
             int((self.points[0][0] + self.points[1][0]) / 2), int((self.points[0][1] + self.points[1][1]) / 2))
-        rx = math.fabs(self.points[0][0] - self.points[1][0]) / 2
-        ry = math.fabs(self.points[0][1] - self.points[1][1]) / 2
-
-        # first part
-        x, y = 0, int(ry)
-        decider = ry ** 2 - rx ** 2 * ry + rx ** 2 / 4
-        while ry ** 2 * x < rx ** 2 * y:
-            result.append((x, y))
-            x += 1
-            y -= 1 if decider >= 0 else 0
-            decider += 2 * ry ** 2 * x + ry ** 2 - \
-                       (2 * rx ** 2 * y if decider >= 0 else 0)
-        # second part
-        decider = ry ** 2 * (x + 0.5) ** 2 + rx ** 2 * (y - 1) ** 2 - rx ** 2 * ry ** 2
-        while y >= 0:
-            result.append((x, y))
-            y -= 1
-            x += 1 if decider <= 0 else 0
-            decider += rx ** 2 - 2 * rx ** 2 * y + \
-                       (2 * ry ** 2 * x if decider <= 0 else 0)
-
-        # complete the ellipse by making mirrored copies and assembling them
-        result.extend(flipPointsX(result))
-        result.extend(flipPointsY(result))
-        # translate the ellipse from origin to the proper location
-        result = translatePoints(result, ellipseCenter)
-        return result
+        # outlines are shared by ellipses of the same size, only the offset is paid for each one
+        outline = getEllipseOutline(abs(self.points[0][0] - self.points[1][0]),
+                                    abs(self.points[0][1] - self.points[1][1]))
+        return outline + np.array(ellipseCenter, np.int64)
+
+    def getBoundingBox(self):
+        # the midpoint algorithm may step one pixel past the radius
+        x0, y0, x1, y1 = super().getBoundingBox()
+        return x0 - 1, y0 - 1, x1 + 1, y1 + 1
+
+    def canShiftRaster(self, displacement):
+        # the center is truncated by int()
+        return isIntegralShift(self.points, displacement)
 
     # don't need to rotate an ellipse
     def rotate(self, center, degree):
         raise Exception("rotating an ellipse")
 
 
-def isBesidePoints(pointA, pointB):
-    return math.fabs(pointA[0] - pointB[0]) <= 1 and math.fabs(pointA[1] - pointB[1]) <= 1
+def getBernsteinBasis(degree, us):
+    """
+    matrix of Bernstein polynomials of degree, one row for each parameter in us and one column for each polynomial
+    they are evaluated in logs, so binomials and powers of high degrees don't overflow
+    """
+    k = np.arange(degree + 1)
+    logBinomials = np.concatenate([[0.0], np.cumsum(np.log(degree - k[1:] + 1) - np.log(k[1:]))])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logU = np.log(us)[:, np.newaxis]
+        logV = np.log1p(-us)[:, np.newaxis]
+        terms = logBinomials + np.where(k > 0, k * logU, 0) + np.where(k < degree, (degree - k) * logV, 0)
+    return np.exp(terms)
+
+
+def evaluateBezier(points, us, maxWork=1 << 20):
+    """
+    evaluate a Bezier curve at many parameters at once
+    points is an (n, 2) array of control points and us a vector of parameters
+    return a (len(us), 2) float array
+    parameters are worked on in chunks, keeping each basis matrix within maxWork numbers
+    """
+    result = np.empty((len(us), 2), np.float64)
+    chunk = max(1, maxWork // len(points))
+    for begin in range(0, len(us), chunk):
+        result[begin:begin + chunk] = getBernsteinBasis(len(points) - 1, us[begin:begin + chunk]) @ points
+    return result
+
+
+def flattenCurve(evaluate, us, points, tolerance):
+    """
+    flatten a curve into a polyline whose pieces stay within tolerance of it
+    evaluate maps a vector of parameters to an array of points, us are starting parameters and points the curve at them,
+    they must be close enough that the curve bends at most once between neighbours
+    a piece is split at its middle parameter while the curve at one of its eighths is farther than tolerance from the
+    segment between its ends, all pieces of a round are checked with one call to evaluate
+    return the vertices of the polyline
+    """
+    us = np.asarray(us, np.float64)
+    points = np.asarray(points, np.float64)
+    checking = np.ones(len(us) - 1, bool)
+    # the middle comes first to be reused as the new vertex, a few samples miss pieces whose curve crosses the chord
+    # at them, like an S
+    fractions = np.array([0.5, 0.125, 0.25, 0.375, 0.625, 0.75, 0.875])
+    while checking.any():
+        pieces = np.flatnonzero(checking)
+        lows, highs = us[pieces], us[pieces + 1]
+        samples = evaluate((lows + np.outer(fractions, highs - lows)).ravel()).reshape(len(fractions), len(pieces), -1)
+        starts, ends = points[pieces], points[pieces + 1]
+        chords = ends - starts
+        offsets = samples - starts
+        # distance to the segment rather than its line, a curve may run past the ends of the chord
+        ts = np.clip((offsets * chords).sum(axis=-1) / np.maximum((chords ** 2).sum(axis=-1), 1e-12), 0, 1)
+        nearest = offsets - ts[..., None] * chords
+        distances = np.hypot(nearest[..., 0], nearest[..., 1]).max(axis=0)
+        middles, middlePoints = (lows + highs) / 2, samples[0]
+        split = (distances > tolerance) & (highs - lows > 1e-9)
+
+        # both halves of a split piece are checked in the next round, the others are done
+        checking = np.zeros(len(us) - 1, bool)
+        checking[pieces[split]] = True
+        checking = np.repeat(checking, np.where(checking, 2, 1))
+        us = np.insert(us, pieces[split] + 1, middles[split])
+        points = np.insert(points, pieces[split] + 1, middlePoints[split], axis=0)
+    return points
+
+
+def drawPolyline(vertices, viewport=None):
+    """ rasterize a polyline by Bresenham, vertices are truncated to pixels like int() """
+    vertices = removeRepeatedPixels(np.trunc(vertices).astype(np.int64))
+    # Bresenham leaves out ends of some segments, so vertices are drawn as well
+    return np.concatenate([rasterizeLinesByBresenham(vertices[:-1], vertices[1:], viewport), vertices])
+
+
+def removeRepeatedPixels(pixels):
+    """ drop pixels which are the same as the one before them """
+    if len(pixels) == 0:
+        return pixels
+    keep = np.ones(len(pixels), bool)
+    keep[1:] = (pixels[1:] != pixels[:-1]).any(axis=1)
+    return pixels[keep]
+
+
+def evaluateDeBoor(points, k, ts):
+    """
+    evaluate segments of a uniform B-spline of degree k at many local parameters at once by de Boor's algorithm
+    points are the k + 1 control points of a segment shared by all parameters, or a stack of them, one for each
+    parameter, ts are the parameters in [0, 1]
+    return a (len(ts), dimension) array
+    """
+    points = np.asarray(points, np.float64)
+    levels = np.array(np.broadcast_to(points, (len(ts),) + points.shape[-2:]))
+    t = np.asarray(ts, np.float64)[:, np.newaxis]
+    for r in range(1, k + 1):
+        # going down keeps levels[:, m - 1] from the pass before while levels[:, m] is replaced
+        for m in range(k, r - 1, -1):
+            weight = (t + k - m) / (k + 1 - r)
+            levels[:, m] = weight * levels[:, m] + (1 - weight) * levels[:, m - 1]
+    return levels[:, k]
+
+
+@functools.lru_cache(maxsize=256)
+def getUniformBSplineBasis(k, samples):
+    """
+    basis matrix of a segment of a uniform B-spline of degree k, read-only
+    one row for each of samples parameters evenly spread over [0, 1], one column for each control point of the segment
+    """
+    basis = evaluateDeBoor(np.identity(k + 1), k, np.linspace(0, 1, samples))
+    basis.flags.writeable = False
+    return basis
+
+
+def evaluateBSpline(points, k, us):
+    """
+    evaluate a uniform B-spline of degree k at many parameters in [k, number of points] at once
+    return a (len(us), 2) array
+    """
+    segments = np.minimum(np.floor(us).astype(np.int64), len(points) - 1)
+    windows = np.lib.stride_tricks.sliding_window_view(points, k + 1, axis=0)
+    return evaluateDeBoor(windows[segments - k].transpose(0, 2, 1), k, us - segments)
 
 
 class Curve(MetaGraphic):
-    def __init__(self, algorithm: string, color, pointList):
+    # pieces of each Bezier degree or B-spline segment to start flattening with
+    startingPieces = 4
+
+    def __init__(self, algorithm: string, color, pointList, k=3, tolerance=0.5):
         super().__init__(algorithm, color, pointList)
+        # degree of B-spline
+        self.k = k
+        # farthest distance in pixels allowed between the curve and the polyline drawn for it
+        self.tolerance = tolerance
 
     def draw(self):
-        result = []
+        result = toPixelArray([])
         if self.algorithm == "Bezier":
             result = self.drawByBezier()
         elif self.algorithm == "B-spline":
-            result = self.drawByBSpline(3)
+            result = self.drawByBSpline(self.k)
         return result
 
     def drawByBezier(self):
-        start = self.deCasteljau(0)
-        end = self.deCasteljau(1.0)
-        result = self.drawCurve(0, start, 1, end, self.deCasteljau)
-        result.append(start)
-        result.append(end)
-        return result
-
-    """general structure of drawing a curve"""
-
-    def drawCurve(self, ul, lastPoint, un, nextPoint, generator):
-        if isBesidePoints(lastPoint, nextPoint) or math.fabs(ul - un) <= 0.0001:  # avoid recursion being too deep
-            return []
-
-        u = (ul + un) / 2
-        point = generator(u)
-
-        result = self.drawCurve(ul, lastPoint, u, point, generator)
-        result.extend(self.drawCurve(u, point, un, nextPoint, generator))
-
-        if point != lastPoint and point != nextPoint:
-            result.append(point)
-        return result
-
-    def deCasteljau(self, u):
-        point = Curve.deCasteljauRecursive(u, self.points)
-        return int(point[0]), int(point[1])
-
-    @staticmethod
-    def deCasteljauRecursive(u, points):
-        if len(points) == 1:
-            return points[0]
-
-        nextPoints = []
-        for i in range(len(points) - 1):
-            nextPoints.append(((1 - u) * points[i][0] + u * points[i + 1][0],
-                               (1 - u) * points[i][1] + u * points[i + 1][1]))
-        return Curve.deCasteljauRecursive(u, nextPoints)
+        points = np.array(self.points, np.float64)
+        # a Bezier curve of degree n changes direction less than n times
+        us = np.linspace(0, 1, self.startingPieces * (len(points) - 1) + 1)
+        vertices = flattenCurve(lambda u: evaluateBezier(points, u), us, evaluateBezier(points, us), self.tolerance)
+        return drawPolyline(vertices, self.viewport)
 
     def drawByBSpline(self, k):
-        if len(self.points) < 4:
-            return []
-
-        uMin = float(k)
-        start = self.deBoorCox(k, uMin)
-        uMax = float(len(self.points) - 0.001)
-        end = self.deBoorCox(k, uMax)
-        result = self.drawCurve(uMin, start, uMax, end,
-                                lambda u: self.deBoorCox(k, u))
-        result.append(start)
-        result.append(end)
-        return result
-
-    def deBoorCox(self, k, u):
-        j = int(u)
-        point = self.deBoorCoxRecursive(k, j, k, u)
-        return int(point[0]), int(point[1])
-
-    def deBoorCoxRecursive(self, k, i, r, u):
-        if r == 0:
-            return self.points[i]
-        weight = (u - i) / (k + 1 - r)
-        point1 = self.deBoorCoxRecursive(k, i, r - 1, u)
-        point2 = self.deBoorCoxRecursive(k, i - 1, r - 1, u)
-        return (weight * point1[0] + (1 - weight) * point2[0],
-                weight * point1[1] + (1 - weight) * point2[1])
+        """
+        segment j of the curve, u in [j, j + 1) for k <= j < number of points, is shaped by points j - k to j
+        knots are uniform, so every segment starts from the same cached basis matrix, evaluated in one product
+        """
+        points = np.array(self.points, np.float64)
+        if len(points) <= k:
+            return toPixelArray([])
+
+        windows = np.lib.stride_tricks.sliding_window_view(points, k + 1, axis=0)
+        basis = getUniformBSplineBasis(k, self.startingPieces + 1)
+        # the last sample of a segment is the first of the next one
+        starts = np.einsum("sm,jcm->jsc", basis[:-1], windows).reshape(-1, 2)
+        us = np.linspace(k, len(points), self.startingPieces * len(windows) + 1)
+        ends = basis[-1:] @ windows[-1].T
+        vertices = flattenCurve(lambda u: evaluateBSpline(points, k, u), us, np.concatenate([starts, ends]),
+                                self.tolerance)
+        return drawPolyline(vertices, self.viewport)
@@ -0,0 +1,230 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import cg_cli
+
+
+# every scene generator takes a random generator and a scale, returns (algorithm, command list)
+def shortLines(rng, scale, algorithm):
+    size = 1000
+    commands = ["resetCanvas {} {}".format(size, size)]
+    for i in range(int(20000 * scale)):
+        x, y = rng.randrange(size), rng.randrange(size)
+        commands.append("drawLine l{} {} {} {} {} {}".format(
+            i, x, y, x + rng.randint(-10, 10), y + rng.randint(-10, 10), algorithm))
+    commands.append("saveCanvas shortLines")
+    return algorithm, commands
+
+
+def longLines(rng, scale, algorithm):
+    size = 4000
+    commands = ["resetCanvas {} {}".format(size, size)]
+    for i in range(max(1, int(50 * scale))):
+        commands.append("drawLine l{} {} {} {} {} {}".format(
+            i, rng.randrange(size), 0, rng.randrange(size), size - 1, algorithm))
+    # mostly off canvas
+    commands.append("drawLine far -1000000 10 1000000 {} {}".format(size - 10, algorithm))
+    commands.append("saveCanvas longLines")
+    return algorithm, commands
+
+
+def largeEllipses(rng, scale):
+    size = 3000
+    commands = ["resetCanvas {} {}".format(size, size)]
+    for i in range(max(1, int(100 * scale))):
+        x, y = rng.randrange(size), rng.randrange(size)
+        rx, ry = rng.randint(200, 1500), rng.randint(200, 1500)
+        commands.append("drawEllipse e{} {} {} {} {}".format(i, x - rx, y - ry, x + rx, y + ry))
+    commands.append("saveCanvas largeEllipses")
+    return "Midpoint", commands
+
+
+def bezierCurves(rng, scale):
+    size = 2000
+    commands = ["resetCanvas {} {}".format(size, size)]
+    for i in range(max(1, int(40 * scale))):
+        points = " ".join("{} {}".format(rng.randrange(size), rng.randrange(size)) for _ in range(30))
+        commands.append("drawCurve c{} {} Bezier".format(i, points))
+    commands.append("saveCanvas bezierCurves")
+    return "Bezier", commands
+
+
+def bSplineCurves(rng, scale):
+    size = 2000
+    commands = ["resetCanvas {} {}".format(size, size)]
+    for i in range(max(1, int(20 * scale))):
+        points = " ".join("{} {}".format(rng.randrange(size), rng.randrange(size)) for _ in range(500))
+        commands.append("drawCurve c{} {} B-spline".format(i, points))
+    commands.append("saveCanvas bSplineCurves")
+    return "B-spline", commands
+
+
+def transformChains(rng, scale):
+    size = 1000
+    commands = ["resetCanvas {} {}".format(size, size)]
+    gids = []
+    for i in range(100):
+        gid = "g{}".format(i)
+        gids.append(gid)
+        x, y = rng.randrange(size), rng.randrange(size)
+        if i % 2 == 0:
+            commands.append("drawPolygon {} {} {} {} {} {} {} Bresenham".format(
+                gid, x, y, x + 80, y + 10, x + 30, y + 90))
+        else:
+            commands.append("drawLine {} {} {} {} {} DDA".format(gid, x, y, x + 150, y + 60))
+    for i in range(int(10000 * scale)):
+        gid = rng.choice(gids)
+        kind = rng.random()
+        if kind < 0.6:
+            commands.append("translate {} {} {}".format(gid, rng.randint(-20, 20), rng.randint(-20, 20)))
+        elif kind < 0.8:
+            commands.append("rotate {} {} {} {}".format(gid, size // 2, size // 2, rng.randint(0, 359)))
+        else:
+            commands.append("scale {} {} {} {}".format(gid, size // 2, size // 2, rng.choice([0.9, 1.1])))
+        if i % 500 == 499:
+            commands.append("saveCanvas transforms{}".format(i))
+    commands.append("saveCanvas transformChains")
+    return "Transform", commands
+
+
+def manyFrames(rng, scale):
+    size = 600
+    commands = ["resetCanvas {} {}".format(size, size)]
+    for i in range(max(1, int(200 * scale))):
+        x, y = rng.randrange(size), rng.randrange(size)
+        commands.append("drawRectangle r{} {} {} {} {} Bresenham".format(i % 20, x, y, x + 50, y + 40))
+        commands.append("saveCanvas frame{}".format(i))
+    return "saveCanvas", commands
+
+
+scenes = {
+    "shortLines-DDA": lambda rng, scale: shortLines(rng, scale, "DDA"),
+    "shortLines-Bresenham": lambda rng, scale: shortLines(rng, scale, "Bresenham"),
+    "longLines-DDA": lambda rng, scale: longLines(rng, scale, "DDA"),
+    "longLines-Bresenham": lambda rng, scale: longLines(rng, scale, "Bresenham"),
+    "largeEllipses": largeEllipses,
+    "bezierCurves": bezierCurves,
+    "bSplineCurves": bSplineCurves,
+    "transformChains": transformChains,
+    "manyFrames": manyFrames,
+}
+
+
+def runScene(commands, repeat, **options):
+    """
+    render commands repeat times, each in a fresh CommandParser writing into a temporary directory
+    return the best seconds and the pixels graphics produced every time they were painted during a run
+    """
+    best = math.inf
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as outputDir:
+            begin = time.perf_counter()
+            parser = cg_cli.CommandParser(outputDir, **options)
+            try:
+                parser.run(commands)
+            finally:
+                parser.close()
+            best = min(best, time.perf_counter() - begin)
+
+    # pixels are counted by one more run, as a profiler would slow down the timed ones
+    profiler = cg_cli.Profiler()
+    with tempfile.TemporaryDirectory() as outputDir:
+        parser = cg_cli.CommandParser(outputDir, profiler=profiler, **options)
+        try:
+            parser.run(commands)
+        finally:
+            parser.close()
+    return best, profiler.pixelsProduced
+
+
+def runBenchmarks(names, scale=1.0, repeat=3, seed=0, **options):
+    """ run the named scenes, return results as a dict of scene name to measurements """
+    results = {}
+    for name in names:
+        algorithm, commands = scenes[name](random.Random(seed), scale)
+        seconds, pixels = runScene(commands, repeat, **options)
+        results[name] = {
+            "algorithm": algorithm,
+            "commands": len(commands),
+            "pixels": pixels,
+            "seconds": seconds,
+            "commandsPerSecond": len(commands) / seconds,
+            "pixelsPerSecond": pixels / seconds,
+        }
+    return results
+
+
+def compareWithBaseline(results, baseline, threshold):
+    """ return (name, baseline seconds, seconds) of scenes slower than baseline by more than threshold """
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result["seconds"] > baseline[name]["seconds"] * (1 + threshold):
+            regressions.append((name, baseline[name]["seconds"], result["seconds"]))
+    return regressions
+
+
+def parseArguments(argv):
+    argParser = argparse.ArgumentParser(description="render synthetic command scripts and report their speed")
+    argParser.add_argument("scenes", nargs="*", metavar="scene",
+                           help="scenes to run, all by default: " + ", ".join(scenes))
+    argParser.add_argument("--scale", type=float, default=1.0, help="multiply the size of every scene")
+    argParser.add_argument("--repeat", type=int, default=3, help="runs of each scene, the fastest one counts")
+    argParser.add_argument("--seed", type=int, default=0, help="seed of scene generators")
+    argParser.add_argument("--output", help="write results as json to this file")
+    argParser.add_argument("--baseline", help="json results of an earlier run to compare with")
+    argParser.add_argument("--threshold", type=float, default=0.2,
+                           help="fail when a scene is slower than baseline by more than this fraction")
+    argParser.add_argument("--format", choices=cg_cli.imageFormats, default="bmp", help="format of saved images")
+    argParser.add_argument("--writers", type=int, default=2,
+                           help="number of background threads writing images, 0 writes them synchronously")
+    args = argParser.parse_args(argv)
+    for name in args.scenes:
+        if name not in scenes:
+            argParser.error("unknown scene: " + name)
+    if args.repeat < 1:
+        argParser.error("repeat must be positive")
+    return args
+
+
+if __name__ == '__main__':
+    argArgs = parseArguments(sys.argv[1:])
+    argResults = runBenchmarks(argArgs.scenes or list(scenes), argArgs.scale, argArgs.repeat, argArgs.seed,
+                               imageFormat=argArgs.format, writers=argArgs.writers)
+
+    print("{:<22}{:>12}{:>10}{:>12}{:>14}{:>16}".format(
+        "scene", "algorithm", "seconds", "commands", "commands/s", "pixels/s"))
+    for argName, argResult in argResults.items():
+        print("{:<22}{:>12}{:>10.3f}{:>12}{:>14.0f}{:>16.0f}".format(
+            argName, argResult["algorithm"], argResult["seconds"], argResult["commands"],
+            argResult["commandsPerSecond"], argResult["pixelsPerSecond"]))
+
+    if argArgs.output is not None:
+        with open(argArgs.output, "w") as fp:
+            json.dump({
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "scale": argArgs.scale,
+                "seed": argArgs.seed,
+                "results": argResults,
+            }, fp, indent=2)
+
+    if argArgs.baseline is not None:
+        with open(argArgs.baseline, "r") as fp:
+            argBaseline = json.load(fp)
+        if argBaseline.get("scale") != argArgs.scale or argBaseline.get("seed") != argArgs.seed:
+            print("warning: baseline was run with another scale or seed", file=sys.stderr)
+        argRegressions = compareWithBaseline(argResults, argBaseline["results"], argArgs.threshold)
+        for argName, argBefore, argNow in argRegressions:
+            print("regression: {} took {:.3f}s, baseline {:.3f}s".format(argName, argNow, argBefore), file=sys.stderr)
+        sys.exit(1 if argRegressions else 0)
@@ -1,83 +1,404 @@
+import argparse
+import contextlib
+import gc
+import gzip
+import hashlib
+import io
+import json
+import mmap
 import os.path
+import queue
+import shutil
 import string
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from multiprocessing import shared_memory
 
 import numpy as np
 import cg_algorithms as alg
 
 from PIL import Image
 
+# only needed for reading zstd compressed scripts
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Operation:
+    """
+    a parsed command
+    gid is the graphic the command works on, None for commands about the whole canvas
+    args are the typed arguments, in the order the matching Canvas method takes them after gid
+    """
+
+    def __init__(self, opType, gid=None, args=()):
+        self.opType = opType
+        self.gid = gid
+        self.args = args
+
+
+# draw commands and the Canvas methods adding their graphics
+drawMethods = {
+    "drawLine": "addLine",
+    "drawPolygon": "addPolygon",
+    "drawRectangle": "addRectangle",
+    "drawEllipse": "addEllipse",
+    "drawCurve": "addCurve",
+}
+# graphic classes put on canvas by draw commands
+drawTypes = {
+    "drawLine": alg.Line,
+    "drawPolygon": alg.Polygon,
+    "drawRectangle": alg.Rectangle,
+    "drawEllipse": alg.Ellipse,
+    "drawCurve": alg.Curve,
+}
+
 
 class CommandParser:
-    def __init__(self, outputDir):
-        self.canvas = Canvas(0, 0, outputDir)
+    def __init__(self, outputDir, imageFormat="bmp", pngCompression=6, writers=0, mappedDir=None, renderJobs=0,
+                 curveTolerance=0.5, profiler=None, cacheDir=None, cacheSize=1 << 30, checkpointInterval=1000):
+        self.canvas = Canvas(0, 0, outputDir, imageFormat, pngCompression, mappedDir, renderJobs)
+        self.canvas.curveTolerance = curveTolerance
+        if writers > 0:
+            self.canvas.writer = ImageWriter(writers)
+        # commands and canvas work are measured by profiler if there is one
+        self.profiler = profiler
+        self.canvas.profiler = profiler
+        # run resumes from and stores checkpoints in cache if there is one, every checkpointInterval commands
+        self.cache = None
+        self.checkpointInterval = checkpointInterval
+        if cacheDir is not None:
+            # checkpoints only fit runs with the same output and the same way of drawing
+            options = (os.path.abspath(outputDir), imageFormat, pngCompression, curveTolerance)
+            self.cache = CheckpointCache(cacheDir, cacheSize, repr(options))
+        # classes of graphics whose draw operation was left out as dead, by gid, for checking later dead operations
+        self.deadTypes = {}
+
+    def close(self):
+        """ wait for images still being written, then release the canvas and keep checkpoints made by run """
+        try:
+            if self.canvas.writer is not None:
+                self.canvas.writer.close()
+        finally:
+            self.canvas.close()
+        # images saved before the checkpoints are all on disk now
+        if self.cache is not None:
+            self.cache.commit(self.canvas.savedPaths)
 
     def interpret(self, command):
-        """ analyze command string """
+        """ analyze command string and execute it at once """
+        operation = self.parse(command)
+        if operation is not None:
+            self.execute(operation)
+
+    def run(self, commands):
+        """
+        compile all commands first, then execute the operations left
+        with a cache, the run starts from the checkpoint of the longest prefix of commands found in it,
+        and a checkpoint is stored every checkpointInterval commands and after the last one
+        """
+        if self.cache is None:
+            for operation in self.compile(commands):
+                self.execute(operation)
+            return
+
+        commands = list(commands)
+        keys = self.cache.getKeys(commands)
+        start = self.resume(keys)
+        checkpoints = {i: keys[i] for i in range(start + 1, len(commands) + 1)
+                       if i % self.checkpointInterval == 0 or i == len(commands)}
+        for operation in self.compile(commands[start:], {i - start: key for i, key in checkpoints.items()}):
+            self.execute(operation)
+
+    def stream(self, commands, chunkSize=1024, maxChunks=16):
+        """
+        parse commands on a producer thread while executing them on this one, for scripts too long to compile whole
+        parsed operations wait in a queue of at most maxChunks chunks of chunkSize, so memory stays bounded
+        without the rest of the script, operations are only found dead when their graphic is drawn again
+        within the same chunk, and clips are batched within a chunk
+        """
+        chunks = queue.Queue(maxChunks)
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                with measure(self.profiler, "parser", "stream"):
+                    chunk = []
+                    for command in commands:
+                        operation = self.parse(command)
+                        if operation is not None:
+                            chunk.append(operation)
+                        if len(chunk) >= chunkSize:
+                            if stopped.is_set():
+                                return
+                            chunks.put(batchClips(eliminateDeadOperations(chunk, savedAfter=True)))
+                            chunk = []
+                    chunks.put(batchClips(eliminateDeadOperations(chunk)))
+                chunks.put(None)
+            except Exception as error:
+                chunks.put(error)
+
+        producer = threading.Thread(target=produce, name="parser", daemon=True)
+        producer.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                for operation in chunk:
+                    self.execute(operation)
+        finally:
+            # unblock the producer if rendering stopped early
+            stopped.set()
+            while producer.is_alive():
+                with contextlib.suppress(queue.Empty):
+                    chunks.get(timeout=0.1)
+
+    def resume(self, keys):
+        """
+        restore the canvas from the checkpoint after the most commands, keys[i] is the key after i commands
+        return the number of commands it covers, 0 if there is none
+        """
+        stored = self.cache.getStoredKeys()
+        for i in range(len(keys) - 1, 0, -1):
+            if keys[i] not in stored:
+                continue
+            checkpoint = self.cache.load(keys[i])
+            if checkpoint is not None:
+                snapshot, savedPaths, loadedPaths = checkpoint
+                self.canvas.restoreSnapshot(*snapshot)
+                self.canvas.savedPaths = savedPaths
+                self.canvas.loadedPaths = loadedPaths
+                return i
+        return 0
+
+    def compile(self, commands, checkpoints=None):
+        """
+        parse command strings into an operation list, leaving out operations which can't affect any saved image
+        and clipping lines in batches
+        checkpoints maps a number of commands to the key of a checkpoint to be stored after them
+        """
+        checkpoints = {} if checkpoints is None else checkpoints
+        with measure(self.profiler, "parser", "compile"):
+            operations = []
+            for i, command in enumerate(commands):
+                operation = self.parse(command)
+                if operation is not None:
+                    operations.append(operation)
+                if i + 1 in checkpoints:
+                    operations.append(Operation("checkpoint", args=(checkpoints[i + 1],)))
+            return batchClips(eliminateDeadOperations(operations))
+
+    @staticmethod
+    def parse(command):
+        """ analyze command string, return an Operation or None if there is nothing to do """
         words = command.strip().split(' ')
         commandType = words[0]
 
         # comment, the line will be ignored
         if commandType == "#":
-            return
+            return None
         elif commandType == "resetCanvas":
             width = int(words[1])
             height = int(words[2])
-            self.canvas.resetCanvas(width, height)
+            return Operation(commandType, args=(width, height))
         elif commandType == "saveCanvas":
             name = words[1]
-            self.canvas.saveCanvas(name)
+            return Operation(commandType, args=(name,))
+        elif commandType == "saveSnapshot" or commandType == "loadSnapshot":
+            # snapshots of canvas state are kept in output directory as <name>.snapshot
+            name = words[1]
+            return Operation(commandType, args=(name,))
         elif commandType == "setColor":
             color = (int(words[1]), int(words[2]), int(words[3]))
-            self.canvas.setColor(color)
+            return Operation(commandType, args=(color,))
         elif commandType == "drawLine":
             gid = words[1]
             start = (int(words[2]), int(words[3]))
             end = (int(words[4]), int(words[5]))
             algorithm = words[6]
-            self.canvas.addLine(algorithm, gid, [start, end])
+            return Operation(commandType, gid, (algorithm, [start, end]))
         elif commandType == "drawPolygon":
             gid = words[1]
             pointList, end = getPointList(words, 2)
             algorithm = words[end]
-            self.canvas.addPolygon(algorithm, gid, pointList)
+            # a trailing "fill" draws a filled polygon
+            filled = words[end + 1:end + 2] == ["fill"]
+            return Operation(commandType, gid, (algorithm, pointList, filled))
         elif commandType == "drawRectangle":
             gid = words[1]
             pointA = (int(words[2]), int(words[3]))
             pointB = (int(words[4]), int(words[5]))
             algorithm = words[6]
-            self.canvas.addRectangle(algorithm, gid, [pointA, pointB])
+            filled = words[7:8] == ["fill"]
+            return Operation(commandType, gid, (algorithm, [pointA, pointB], filled))
         elif commandType == "drawEllipse":
             gid = words[1]
             pointA = (int(words[2]), int(words[3]))
             pointB = (int(words[4]), int(words[5]))
             algorithm = "Midpoint"
-            self.canvas.addEllipse(algorithm, gid, [pointA, pointB])
+            return Operation(commandType, gid, (algorithm, [pointA, pointB]))
         elif commandType == "drawCurve":
             gid = words[1]
             pointList, end = getPointList(words, 2)
             algorithm = words[end]
-            self.canvas.addCurve(algorithm, gid, pointList)
+            return Operation(commandType, gid, (algorithm, pointList))
         elif commandType == "translate":
             gid = words[1]
             displacement = (int(words[2]), int(words[3]))
-            self.canvas.translate(gid, displacement)
+            return Operation(commandType, gid, (displacement,))
         elif commandType == "rotate":
             gid = words[1]
             center = (int(words[2]), int(words[3]))
             angle = int(words[4])
-            self.canvas.rotate(gid, center, angle)
+            return Operation(commandType, gid, (center, angle))
         elif commandType == "scale":
             gid = words[1]
             center = (int(words[2]), int(words[3]))
             times = float(words[4])
-            self.canvas.scale(gid, center, times)
+            return Operation(commandType, gid, (center, times))
         elif commandType == "clip":
             gid = words[1]
             pointA = (int(words[2]), int(words[3]))
             pointB = (int(words[4]), int(words[5]))
             algorithm = words[6]
-            self.canvas.clip(algorithm, gid, [pointA, pointB])
+            return Operation(commandType, gid, (algorithm, [pointA, pointB]))
+        elif commandType == "clipLines":
+            # clip the given lines, or all of them, to a window by Liang-Barsky
+            pointA = (int(words[1]), int(words[2]))
+            pointB = (int(words[3]), int(words[4]))
+            gids = tuple(word for word in words[5:] if word) or None
+            return Operation(commandType, args=([pointA, pointB], gids, True))
+        return None
+
+    def execute(self, operation):
+        if self.profiler is None:
+            self.perform(operation)
+        else:
+            with self.profiler.measure("command", operation.opType, gid=operation.gid):
+                self.perform(operation)
+
+    def perform(self, operation):
+        opType, gid, args = operation.opType, operation.gid, operation.args
+        if opType == "resetCanvas":
+            self.deadTypes = {}
+            self.canvas.resetCanvas(*args)
+        elif opType == "saveCanvas":
+            self.canvas.saveCanvas(*args)
+        elif opType == "saveSnapshot":
+            self.canvas.saveSnapshot(*args)
+        elif opType == "loadSnapshot":
+            self.deadTypes = {}
+            self.canvas.loadSnapshot(*args)
+        elif opType == "checkpoint":
+            self.cache.store(*args, self.canvas)
+        elif opType == "setColor":
+            self.canvas.setColor(*args)
+        elif opType in drawMethods:
+            algorithm, pointList, *options = args
+            if getattr(self.canvas, drawMethods[opType])(algorithm, gid, pointList, *options):
+                self.deadTypes.pop(gid, None)
+        elif opType == "translate":
+            self.canvas.translate(gid, *args)
+        elif opType == "rotate":
+            self.canvas.rotate(gid, *args)
+        elif opType == "scale":
+            self.canvas.scale(gid, *args)
+        elif opType == "clip":
+            algorithm, pointList = args
+            self.canvas.clip(algorithm, gid, pointList)
+        elif opType == "clipLines":
+            self.canvas.clipLines(*args)
+        elif opType == "check":
+            self.check(*args)
+
+    def check(self, dead):
+        """
+        raise the error a dead operation would raise if it were performed, without performing it
+        a dead draw only records the class of its graphic, other operations need their gid on canvas
+        or drawn by a dead draw, and rotating an ellipse or clipping a non-line fails as it does on the graphic
+        """
+        if dead.opType in drawTypes:
+            if replacesGraphic(dead):
+                self.deadTypes[dead.gid] = drawTypes[dead.opType]
+            return
+        graphicType = self.deadTypes.get(dead.gid) or type(self.canvas.graphics[dead.gid])
+        if dead.opType == "rotate" and issubclass(graphicType, alg.Ellipse):
+            raise Exception("rotating an ellipse")
+        if dead.opType == "clip" and not issubclass(graphicType, alg.Line):
+            raise Exception("clipping a non-line graphic")
+
+
+def replacesGraphic(operation):
+    """ check whether a draw operation really puts a graphic under its gid, same as the checks in Canvas """
+    algorithm, pointList = operation.args[:2]
+    if operation.opType == "drawCurve":
+        return len(pointList) >= (4 if algorithm == "B-spline" else 2)
+    return operation.opType == "drawPolygon" or len(pointList) >= 2
+
+
+def eliminateDeadOperations(operations, savedAfter=False):
+    """
+    drop operations on graphics which are never saved, each one is replaced by a check raising what it would raise
+    a graphic lives from its draw operation until its gid is drawn again or the canvas is reset,
+    operations on it count only if some saveCanvas comes after them during its life
+    walking backwards, saved tells whether a saveCanvas is ahead in the current canvas,
+    shadowed holds gids drawn again before that saveCanvas
+    savedAfter tells the operations are followed by others which may save, as for a chunk of a stream
+    """
+    alive = []
+    saved = savedAfter
+    shadowed = set()
+    for operation in reversed(operations):
+        # a snapshot or checkpoint keeps every graphic like a saved image does,
+        # loading a snapshot replaces the canvas like a reset
+        if operation.opType in ("saveCanvas", "saveSnapshot", "checkpoint"):
+            saved = True
+            shadowed = set()
+        elif operation.opType == "resetCanvas" or operation.opType == "loadSnapshot":
+            saved = False
+            shadowed = set()
+        elif operation.gid is not None:
+            if not saved or operation.gid in shadowed:
+                alive.append(Operation("check", operation.gid, (operation,)))
+                continue
+            if operation.opType in drawMethods and replacesGraphic(operation):
+                shadowed.add(operation.gid)
+        alive.append(operation)
+    alive.reverse()
+    return alive
+
+
+def batchClips(operations):
+    """
+    merge each run of Liang-Barsky clips of different gids to the same window into one clipLines operation
+    clipping one line doesn't affect another, so the run can be done in one batch
+    unlike a clipLines command, the batch raises for a gid not on canvas as each clip would
+    """
+    result = []
+    for operation in operations:
+        if operation.opType == "clip" and operation.args[0] == "Liang-Barsky":
+            window = operation.args[1]
+            last = result[-1] if result else None
+            # clipLines commands skip missing gids, only batches of clips are extended
+            if last is not None and last.opType == "clipLines" and not last.args[2] and last.args[0] == window \
+                    and operation.gid not in last.args[1]:
+                last.args = (window, last.args[1] + (operation.gid,), False)
+            else:
+                result.append(Operation("clipLines", args=(window, (operation.gid,), False)))
+        else:
+            result.append(operation)
+    return result
 
 
 # get a pointList from command words, return pointList and the index after ones representing points
@@ -94,53 +415,394 @@ def getPointList(words, start):
     return pointList, i
 
 
+def isOverlapping(regionA, regionB):
+    """ check whether two boxes (x0, y0, x1, y1) with exclusive x1 and y1 overlap """
+    return regionA[0] < regionB[2] and regionB[0] < regionA[2] and regionA[1] < regionB[3] and regionB[1] < regionA[3]
+
+
+def unionRegion(regionA, regionB):
+    return (min(regionA[0], regionB[0]), min(regionA[1], regionB[1]),
+            max(regionA[2], regionB[2]), max(regionA[3], regionB[3]))
+
+
+def mergeRegions(regions, maxCount):
+    """
+    merge overlapping boxes until none of them overlap
+    if there are more than maxCount boxes, return their union instead, without merging them one by one
+    """
+    if len(regions) > maxCount:
+        xs0, ys0, xs1, ys1 = zip(*regions)
+        return [(min(xs0), min(ys0), max(xs1), max(ys1))]
+    merged = []
+    for region in regions:
+        # absorb every box overlapping the new one, the grown box may overlap more of them
+        absorbed = True
+        while absorbed:
+            absorbed = False
+            for other in merged:
+                if isOverlapping(region, other):
+                    merged.remove(other)
+                    region = unionRegion(region, other)
+                    absorbed = True
+                    break
+        merged.append(region)
+    return merged
+
+
+class GridIndex:
+    """
+    uniform grid over bounding boxes (x0, y0, x1, y1) of graphics
+    answers which graphics touch a region without looking at the others
+    """
+    # boxes covering more cells than this are kept aside and checked on every query
+    maxCells = 256
+
+    def __init__(self, cellSize=64):
+        self.cellSize = cellSize
+        self.cells = {}
+        self.large = set()
+        self.boxes = {}
+
+    def getCells(self, region):
+        x0, y0, x1, y1 = region
+        size = self.cellSize
+        return [(cx, cy) for cx in range(x0 // size, (x1 - 1) // size + 1)
+                for cy in range(y0 // size, (y1 - 1) // size + 1)]
+
+    def insert(self, gid, box):
+        """ index gid by box, a graphic without any box is only remembered """
+        self.boxes[gid] = box
+        if box is None:
+            return
+        cells = self.getCells(box)
+        if len(cells) > self.maxCells:
+            self.large.add(gid)
+            return
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(gid)
+
+    def remove(self, gid):
+        """ remove gid from the index, return its box """
+        box = self.boxes.pop(gid, None)
+        if box is None:
+            return None
+        if gid in self.large:
+            self.large.remove(gid)
+            return box
+        for cell in self.getCells(box):
+            gids = self.cells[cell]
+            gids.discard(gid)
+            if not gids:
+                del self.cells[cell]
+        return box
+
+    def query(self, region):
+        """ return gids whose boxes overlap region """
+        candidates = set(self.large)
+        for cell in self.getCells(region):
+            candidates.update(self.cells.get(cell, ()))
+        return {gid for gid in candidates if isOverlapping(self.boxes[gid], region)}
+
+    def clear(self):
+        self.cells = {}
+        self.large = set()
+        self.boxes = {}
+
+
 class Canvas:
-    def __init__(self, width, height, outputDir):
+    # more dirty regions than this are merged into one before redrawing
+    maxDirtyRegions = 16
+    # a memory-mapped bitmap is cleared, redrawn and saved this many rows at a time
+    mappedTileRows = 512
+    # dirty regions are painted by render workers only if they cover this many pixels, in square tiles of this size
+    parallelArea = 512 * 512
+    renderTileSize = 256
+
+    def __init__(self, width, height, outputDir, imageFormat="bmp", pngCompression=6, mappedDir=None, renderJobs=0):
         self.tempGraphic = None
         self.width = width
         self.height = height
         self.outputDir = outputDir
-        self.bitmap = np.zeros((self.height, self.width, 3), np.uint8)
+        self.imageFormat = imageFormat
+        self.pngCompression = pngCompression
+        # images are written in background by writer if there is one
+        self.writer = None
+        # work on canvas is measured by profiler if there is one
+        self.profiler = None
+        # every image and snapshot saved, in order
+        self.savedPaths = []
+        # every snapshot loaded, in order
+        self.loadedPaths = []
+        # bitmap is backed by a temporary file in mappedDir if it is given
+        self.mappedDir = mappedDir
+        self.bitmapFile = None
+        # large regions are painted by renderJobs worker processes if it is positive, bitmap is shared with them
+        self.renderJobs = renderJobs
+        self.renderPool = None
+        self.sharedMemory = None
+        self.bitmapLocation = None
+        self.bitmap = self.allocateBitmap()
         self.graphics = {}
         self.penColor = (0, 0, 0)
+        # farthest distance in pixels allowed between a curve and the polyline drawn for it
+        self.curveTolerance = 0.5
+        # bounding boxes of graphics as painted on bitmap, graphics changed since then and regions to redraw
+        self.index = GridIndex()
+        self.staleGids = set()
+        self.dirtyRegions = []
 
     def update(self):
-        """ clear and then redraw all graphics """
-        self.bitmap = np.zeros((self.height, self.width, 3), np.uint8)
-        for gid in sorted(self.graphics.keys()):
-            self.drawGraphic(self.graphics[gid])
-        if self.tempGraphic is not None:
-            # temporary graphic will only be drawn once
-            self.drawGraphic(self.tempGraphic)
-            self.tempGraphic = None
+        """ redraw the regions touched by graphics changed since the last update """
+        with measure(self.profiler, "canvas", "update"):
+            self.updateBounds()
+            regions = mergeRegions(self.dirtyRegions, self.maxDirtyRegions)
+            self.dirtyRegions = []
+            if self.renderJobs > 0 and self.bitmapLocation is not None and \
+                    sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions) >= self.parallelArea:
+                self.paintRegionsInParallel(regions)
+                return
+            for region in regions:
+                self.paintRegion(region)
+
+    def updateBounds(self):
+        """
+        move bounding boxes of changed graphics in the index, marking both old and new ones dirty
+        changed lines are rasterized in batches meanwhile, so painting them finds their rasters ready
+        """
+        alg.rasterizeLines([self.graphics[gid] for gid in self.staleGids
+                            if isinstance(self.graphics.get(gid), alg.Line)])
+        for gid in self.staleGids:
+            self.markDirty(self.index.remove(gid))
+            if gid in self.graphics:
+                bounds = self.getBounds(self.graphics[gid])
+                self.index.insert(gid, bounds)
+                self.markDirty(bounds)
+        self.staleGids = set()
+
+    def allocateBitmap(self):
+        """
+        return a cleared bitmap
+        it is memory-mapped to a temporary file if mappedDir is set, or else put in shared memory if renderJobs is set,
+        bitmapLocation tells worker processes where to find it then
+        """
+        shape = (self.height, self.width, 3)
+        self.bitmapLocation = None
+        if self.width * self.height == 0:
+            return np.zeros(shape, np.uint8)
+        if self.mappedDir is not None:
+            self.bitmapFile = tempfile.NamedTemporaryFile(dir=self.mappedDir, suffix=".bitmap")
+            self.bitmapLocation = ("file", self.bitmapFile.name, shape)
+            return np.memmap(self.bitmapFile.name, np.uint8, "w+", shape=shape)
+        if self.renderJobs > 0:
+            self.sharedMemory = shared_memory.SharedMemory(create=True, size=self.width * self.height * 3)
+            self.bitmapLocation = ("shm", self.sharedMemory.name, shape)
+            bitmap = np.ndarray(shape, np.uint8, buffer=self.sharedMemory.buf)
+            bitmap[:] = 0
+            return bitmap
+        return np.zeros(shape, np.uint8)
+
+    def releaseBitmap(self):
+        """ drop bitmap together with its temporary file or shared memory """
+        self.bitmap = None
+        if self.bitmapFile is not None:
+            self.bitmapFile.close()
+            self.bitmapFile = None
+        if self.sharedMemory is not None:
+            self.sharedMemory.close()
+            self.sharedMemory.unlink()
+            self.sharedMemory = None
+
+    def close(self):
+        """ release bitmap and stop render workers """
+        if self.renderPool is not None:
+            self.renderPool.shutdown()
+            self.renderPool = None
+        self.releaseBitmap()
+
+    def isMapped(self):
+        return isinstance(self.bitmap, np.memmap)
+
+    def paintRegion(self, region):
+        """
+        clear a region and redraw graphics overlapping it in z-order
+        a memory-mapped bitmap is painted in bands of rows, each band is let go once done to bound resident memory
+        """
+        x0, y0, x1, y1 = region
+        rows = self.mappedTileRows if self.isMapped() else y1 - y0
+        for top in range(y0, y1, rows):
+            tile = (x0, top, x1, min(top + rows, y1))
+            self.bitmap[tile[1]:tile[3], x0:x1] = 0
+            for gid in sorted(self.index.query(tile)):
+                self.drawGraphic(self.graphics[gid], tile, gid)
+            if self.isMapped():
+                releaseRows(self.bitmap, tile[1], tile[3])
+
+    def paintRegionsInParallel(self, regions):
+        """
+        split regions into tiles and let worker processes paint them straight into the shared bitmap
+        tiles never overlap, and each one is painted with graphics in z-order, so the result is the same as
+        painting the regions one by one
+        """
+        tiles = []
+        for x0, y0, x1, y1 in regions:
+            for top in range(y0, y1, self.renderTileSize):
+                for left in range(x0, x1, self.renderTileSize):
+                    tile = (left, top, min(left + self.renderTileSize, x1), min(top + self.renderTileSize, y1))
+                    tiles.append((tile, [self.graphics[gid] for gid in sorted(self.index.query(tile))]))
 
-    def drawGraphic(self, graphic):
-        """ draw a single graphic on bitmap """
-        color = graphic.getColor()
-        for x, y in graphic.draw():
-            if 0 <= x < self.width and 0 <= y < self.height:
-                # print(x, y)
-                self.bitmap[y][x] = color
+        # neighbouring tiles go to the same task, so graphics shared by them are sent and drawn once
+        if self.renderPool is None:
+            self.renderPool = ProcessPoolExecutor(max_workers=self.renderJobs)
+        taskCount = min(len(tiles), 4 * self.renderJobs)
+        tasks = [tiles[len(tiles) * i // taskCount:len(tiles) * (i + 1) // taskCount] for i in range(taskCount)]
+        with measure(self.profiler, "canvas", "paintTiles", tiles=len(tiles)):
+            for future in [self.renderPool.submit(paintTiles, self.bitmapLocation, task) for task in tasks]:
+                future.result()
+
+    def findGraphic(self, x, y, tolerance=2):
+        """ return gid of the topmost graphic with a pixel within tolerance of (x, y), None if there is none """
+        self.updateBounds()
+        region = (x - tolerance, y - tolerance, x + tolerance + 1, y + tolerance + 1)
+        for gid in sorted(self.index.query(region), reverse=True):
+            if self.graphics[gid].isNear(x, y, tolerance):
+                return gid
+        return None
+
+    def drawGraphic(self, graphic, region=None, gid=None):
+        """ draw a single graphic on bitmap, only inside region if given, gid only names it for profiler """
+        region = (0, 0, self.width, self.height) if region is None else region
+        if self.profiler is None:
+            graphic.paint(self.bitmap, region)
+            return
+        with self.profiler.measure("graphic", str(gid), type=type(graphic).__name__, algorithm=graphic.algorithm):
+            produced, written = graphic.paint(self.bitmap, region)
+        self.profiler.countPixels(produced, written)
+
+    def getPixelsInside(self, graphic, region=None):
+        """ return xs and ys of pixels of a graphic inside region, or inside the canvas if region is None """
+        x0, y0, x1, y1 = (0, 0, self.width, self.height) if region is None else region
+        pixels = graphic.rasterize()
+        xs, ys = pixels[:, 0], pixels[:, 1]
+        inside = (x0 <= xs) & (xs < x1) & (y0 <= ys) & (ys < y1)
+        return xs[inside], ys[inside]
+
+    def getBounds(self, graphic):
+        """ return the bounding box (x0, y0, x1, y1) of a graphic inside the canvas, None if there is none """
+        box = graphic.getBoundingBox()
+        if box is None:
+            return None
+        x0, y0, x1, y1 = max(box[0], 0), max(box[1], 0), min(box[2], self.width), min(box[3], self.height)
+        return (int(x0), int(y0), int(x1), int(y1)) if x0 < x1 and y0 < y1 else None
+
+    def markDirty(self, region):
+        if region is not None:
+            self.dirtyRegions.append(region)
 
     def addGraphic(self, graphic, gid):
+        # only pixels on canvas are drawn
+        graphic.viewport = (0, 0, self.width, self.height)
         if gid == "Temporary":
             self.tempGraphic = graphic
         else:
             self.graphics[gid] = graphic
+            self.staleGids.add(gid)
 
     def resetCanvas(self, width, height):
         self.height = height
         self.width = width
-        self.bitmap = np.zeros((self.height, self.width, 3), np.uint8)
+        self.releaseBitmap()
+        self.bitmap = self.allocateBitmap()
         self.graphics = {}
+        self.index.clear()
+        self.staleGids = set()
+        self.dirtyRegions = []
+
+    def saveSnapshot(self, name):
+        """ write canvas state into directory <name>.snapshot in outputDir, see writeSnapshot """
+        path = os.path.join(self.outputDir, name + ".snapshot")
+        writeSnapshot(self, path)
+        self.savedPaths.append(os.path.join(path, "canvas.json"))
+
+    def loadSnapshot(self, name):
+        """ replace canvas state by snapshot <name>.snapshot in outputDir, name may be an absolute path """
+        path = os.path.join(self.outputDir, name + ".snapshot")
+        self.restoreSnapshot(*readSnapshot(path))
+        self.loadedPaths.append(os.path.join(path, "canvas.json"))
+
+    def restoreSnapshot(self, width, height, penColor, graphics):
+        """ replace canvas state by the one read from a snapshot """
+        self.resetCanvas(width, height)
+        self.penColor = penColor
+        # same as adding them one by one
+        viewport = (0, 0, self.width, self.height)
+        for gid, graphic in graphics:
+            graphic.viewport = viewport
+        self.graphics = dict(graphics)
+        self.staleGids = set(self.graphics)
 
     def saveCanvas(self, name: string):
+        path = os.path.join(self.outputDir, name + "." + self.imageFormat)
+        self.savedPaths.append(path)
+        encode, stream = writeImage, streamImage
+        if self.profiler is not None:
+            # encoding is measured apart from drawing, also on writer threads
+            encode = self.profiler.wrap("encode", self.imageFormat, writeImage)
+            stream = self.profiler.wrap("encode", self.imageFormat, streamImage)
+        if self.isMapped():
+            # a mapped bitmap is too large to snapshot, stream it from the file instead
+            self.update()
+            with self.blendTemporary():
+                stream(self.bitmap, path, self.imageFormat, self.pngCompression, self.mappedTileRows)
+        elif self.writer is None:
+            encode(self.getBitmap(), path, self.imageFormat, self.pngCompression)
+        else:
+            self.writer.submit(self.getBitmap(), path, self.imageFormat, self.pngCompression, encode)
+
+    def getBitmap(self):
+        """ return a copy of bitmap with the temporary graphic drawn on it """
         self.update()
-        Image.fromarray(self.bitmap).save(os.path.join(self.outputDir, name + ".bmp"), "BMP")
+        with self.blendTemporary():
+            return self.bitmap.copy()
 
     def getImage(self):
+        """ return an image of committed graphics with the temporary graphic blended on top """
         self.update()
-        return Image.fromarray(self.bitmap)
+        with self.blendTemporary():
+            return Image.fromarray(self.bitmap)
+
+    @contextlib.contextmanager
+    def blendTemporary(self):
+        """
+        draw the temporary graphic on bitmap for the duration of the block
+        bitmap only holds committed graphics, so pixels covered by the temporary graphic are restored afterwards,
+        costing only as much as the temporary graphic itself
+        """
+        if self.tempGraphic is None:
+            yield
+            return
+
+        if isinstance(self.tempGraphic, alg.Polygon) and self.tempGraphic.filled:
+            # a filled polygon covers its whole box rather than a few pixels
+            bounds = self.getBounds(self.tempGraphic)
+            x0, y0, x1, y1 = bounds if bounds is not None else (0, 0, 0, 0)
+            covered = self.bitmap[y0:y1, x0:x1].copy()
+            self.drawGraphic(self.tempGraphic)
+
+            def restore():
+                self.bitmap[y0:y1, x0:x1] = covered
+        else:
+            xs, ys = self.getPixelsInside(self.tempGraphic)
+            covered = self.bitmap[ys, xs]
+            self.bitmap[ys, xs] = self.tempGraphic.getColor()
+
+            def restore():
+                self.bitmap[ys, xs] = covered
+        try:
+            yield
+        finally:
+            restore()
+            # temporary graphic will only be drawn once
+            self.tempGraphic = None
 
     def setColor(self, color):
         self.penColor = color
@@ -152,15 +814,15 @@ class Canvas:
         self.addGraphic(line, gid)
         return True
 
-    def addPolygon(self, algorithm, gid, pointList):
-        polygon = alg.Polygon(algorithm, self.penColor, pointList)
+    def addPolygon(self, algorithm, gid, pointList, filled=False):
+        polygon = alg.Polygon(algorithm, self.penColor, pointList, filled)
         self.addGraphic(polygon, gid)
         return True
 
-    def addRectangle(self, algorithm, gid, pointList):
+    def addRectangle(self, algorithm, gid, pointList, filled=False):
         if len(pointList) < 2:
             return False
-        rectangle = alg.Rectangle(algorithm, self.penColor, pointList[0], pointList[1])
+        rectangle = alg.Rectangle(algorithm, self.penColor, pointList[0], pointList[1], filled)
         self.addGraphic(rectangle, gid)
         return True
 
@@ -176,31 +838,682 @@ class Canvas:
             return False
         elif algorithm == "B-spline" and len(pointList) < 4:
             return False
-        curve = alg.Curve(algorithm, self.penColor, pointList)
+        curve = alg.Curve(algorithm, self.penColor, pointList, tolerance=self.curveTolerance)
         self.addGraphic(curve, gid)
         return True
 
     def translate(self, gid, displacement):
         self.graphics[gid].translate(displacement)
+        self.staleGids.add(gid)
 
     def rotate(self, gid, center, angle):
         self.graphics[gid].rotate(center, angle)
+        self.staleGids.add(gid)
 
     def scale(self, gid, center, times):
         self.graphics[gid].scale(center, times)
+        self.staleGids.add(gid)
 
     def clip(self, algorithm, gid, pointList):
         self.graphics[gid].clip(algorithm, pointList[0], pointList[1])
+        self.staleGids.add(gid)
+
+    def clipLines(self, pointList, gids=None, skipMissing=True):
+        """
+        clip lines to a window by Liang-Barsky in one batch, all lines if gids is None
+        given gids not on canvas are skipped, or raise KeyError like clip without skipMissing,
+        other graphics are clipped one by one as clip does
+        """
+        if gids is None:
+            gids = [gid for gid, graphic in self.graphics.items() if isinstance(graphic, alg.Line)]
+        lines = []
+        for gid in gids:
+            if gid not in self.graphics:
+                if skipMissing:
+                    continue
+                raise KeyError(gid)
+            if not isinstance(self.graphics[gid], alg.Line):
+                self.clip("Liang-Barsky", gid, pointList)
+            elif not self.graphics[gid].clippedAll:
+                lines.append(gid)
+        if not lines:
+            return
+
+        starts = [self.graphics[gid].points[0] for gid in lines]
+        ends = [self.graphics[gid].points[1] for gid in lines]
+        visible, starts, ends = alg.clipLinesByLiangBarsky(starts, ends, pointList[0], pointList[1])
+        for gid, isVisible, start, end in zip(lines, visible.tolist(), starts.tolist(), ends.tolist()):
+            self.graphics[gid].setClipped(isVisible, tuple(start), tuple(end))
+            self.graphics[gid].invalidate()
+            self.staleGids.add(gid)
+
+
+# graphic types and algorithms a snapshot can hold, a graphic stores their indices
+snapshotTypes = (alg.Line, alg.Polygon, alg.Rectangle, alg.Ellipse, alg.Curve)
+snapshotAlgorithms = ("DDA", "Bresenham", "Midpoint", "Bezier", "B-spline")
+snapshotVersion = 2
+# one packed record per graphic, its control points are points[first:first + count]
+graphicRecord = np.dtype([("type", "u1"), ("algorithm", "u1"), ("filled", "?"), ("clippedAll", "?"), ("k", "u1"),
+                          ("color", "u1", (3,)), ("tolerance", "<f8"), ("matrix", "<f8", (2, 3)),
+                          ("offset", "<i8", (2,)), ("first", "<i8"), ("count", "<i8")])
+pointRecord = np.dtype([("x", "<f8"), ("y", "<f8")])
+
+
+def writeSnapshot(canvas, path):
+    """
+    write graphics of canvas into directory path as packed numpy arrays, so they can be mapped back at once
+    graphics.npy holds a graphicRecord for each graphic, gids.npy their gids and points.npy all control points,
+    canvas.json the size of canvas and pen color, it is written last so a snapshot with it is complete
+    """
+    os.makedirs(path, exist_ok=True)
+    gids = list(canvas.graphics)
+    graphics = [canvas.graphics[gid] for gid in gids]
+    records = np.zeros(len(graphics), graphicRecord)
+    counts = np.array([len(graphic.controlPoints) for graphic in graphics], np.int64)
+    records["count"] = counts
+    records["first"] = np.cumsum(counts) - counts
+    records["type"] = [snapshotTypes.index(type(graphic)) for graphic in graphics]
+    records["algorithm"] = [snapshotAlgorithms.index(graphic.algorithm) for graphic in graphics]
+    records["filled"] = [getattr(graphic, "filled", False) for graphic in graphics]
+    records["clippedAll"] = [getattr(graphic, "clippedAll", False) for graphic in graphics]
+    records["k"] = [getattr(graphic, "k", 0) for graphic in graphics]
+    records["tolerance"] = [getattr(graphic, "tolerance", 0) for graphic in graphics]
+    if graphics:
+        records["color"] = [graphic.getColor() for graphic in graphics]
+        records["matrix"] = np.stack([graphic.matrix[:2] for graphic in graphics])
+        records["offset"] = np.stack([graphic.offset for graphic in graphics])
+    points = np.zeros(int(counts.sum()), pointRecord)
+    if graphics:
+        controlPoints = np.concatenate([graphic.controlPoints for graphic in graphics])
+        points["x"], points["y"] = controlPoints[:, 0], controlPoints[:, 1]
+
+    np.save(os.path.join(path, "graphics.npy"), records)
+    np.save(os.path.join(path, "gids.npy"), np.array(gids, dtype=str))
+    np.save(os.path.join(path, "points.npy"), points)
+    with open(os.path.join(path, "canvas.json"), "w") as fp:
+        json.dump({"version": snapshotVersion, "width": canvas.width, "height": canvas.height,
+                   "penColor": list(canvas.penColor)}, fp)
+
+
+def readSnapshot(path):
+    """
+    read a snapshot written by writeSnapshot, arrays are memory-mapped and control points of graphics are views
+    of the mapped points, so nothing is copied until a graphic changes
+    return width, height, pen color and a list of (gid, graphic)
+    """
+    with open(os.path.join(path, "canvas.json"), "r") as fp:
+        meta = json.load(fp)
+    if meta["version"] != snapshotVersion:
+        raise ValueError("unsupported snapshot version: {}".format(meta["version"]))
+    records = np.load(os.path.join(path, "graphics.npy"), mmap_mode="r")
+    gids = np.load(os.path.join(path, "gids.npy"), mmap_mode="r").tolist()
+    points = np.load(os.path.join(path, "points.npy"), mmap_mode="r")
+    # a plain array over the mapping, slices of np.memmap itself are much slower to make
+    coordinates = np.asarray(points).view(np.float64).reshape(-1, 2)
+    matrices = np.zeros((len(records), 3, 3))
+    matrices[:, :2] = records["matrix"]
+    matrices[:, 2, 2] = 1
+
+    # graphics are rebuilt from their attributes like unpickling does, skipping constructors,
+    # collecting garbage in between would walk all of them again and again
+    graphics = []
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        columns = zip(gids, records["type"].tolist(), records["algorithm"].tolist(), records["filled"].tolist(),
+                      records["clippedAll"].tolist(), records["k"].tolist(), records["color"].tolist(),
+                      records["tolerance"].tolist(), records["first"].tolist(), records["count"].tolist(), matrices,
+                      np.array(records["offset"]))
+        for gid, typeIndex, algorithm, filled, clippedAll, k, color, tolerance, first, count, matrix, offset \
+                in columns:
+            graphicType = snapshotTypes[typeIndex]
+            graphic = graphicType.__new__(graphicType)
+            graphic.__dict__.update(algorithm=snapshotAlgorithms[algorithm], color=tuple(color),
+                                    controlPoints=coordinates[first:first + count], matrix=matrix, offset=offset,
+                                    transformedPoints=None, version=0, raster=None, rasterVersion=-1, viewport=None,
+                                    box=None)
+            if isinstance(graphic, alg.Line):
+                graphic.clippedAll = clippedAll
+            elif isinstance(graphic, alg.Polygon):
+                graphic.__dict__.update(filled=filled, spans=None, spansVersion=-1)
+            elif isinstance(graphic, alg.Curve):
+                graphic.__dict__.update(k=k, tolerance=tolerance)
+            graphics.append((gid, graphic))
+    finally:
+        if collecting:
+            gc.enable()
+    return meta["width"], meta["height"], tuple(meta["penColor"]), graphics
+
+
+# supported image formats, bmp and png are encoded by PIL while npy and ppm are written straight from the array
+imageFormats = ("bmp", "png", "npy", "ppm")
+
+
+def writeImage(bitmap, path, imageFormat, pngCompression=6):
+    """ write an RGB bitmap array to path in imageFormat """
+    if imageFormat == "bmp":
+        Image.fromarray(bitmap).save(path, "BMP")
+    elif imageFormat == "png":
+        Image.fromarray(bitmap).save(path, "PNG", compress_level=pngCompression)
+    elif imageFormat == "npy":
+        np.save(path, bitmap)
+    elif imageFormat == "ppm":
+        with open(path, "wb") as fp:
+            fp.write(b"P6\n%d %d\n255\n" % (bitmap.shape[1], bitmap.shape[0]))
+            fp.write(np.ascontiguousarray(bitmap).tobytes())
+    else:
+        raise ValueError("unknown image format " + imageFormat)
+
+
+def releaseRows(bitmap, top, bottom):
+    """
+    let the kernel drop resident pages of rows [top, bottom) of a memory-mapped bitmap
+    the pages are shared with the file, so their content stays in it
+    """
+    mapping = getattr(bitmap, "_mmap", None)
+    if mapping is None or not hasattr(mmap, "MADV_DONTNEED"):
+        return
+    rowBytes = bitmap.shape[1] * 3
+    start = top * rowBytes // mmap.PAGESIZE * mmap.PAGESIZE
+    end = bottom * rowBytes
+    if end > start:
+        mapping.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def iterateRows(bitmap, rows, reverse=False):
+    """ yield copies of consecutive bands of at most rows rows of a bitmap, releasing mapped pages after each one """
+    height = bitmap.shape[0]
+    tops = range(0, height, rows)
+    for top in (reversed(tops) if reverse else tops):
+        bottom = min(top + rows, height)
+        band = np.array(bitmap[top:bottom])
+        releaseRows(bitmap, top, bottom)
+        yield band[::-1] if reverse else band
+
+
+def writePngChunk(fp, chunkType, data):
+    fp.write(struct.pack(">I", len(data)))
+    fp.write(chunkType + data)
+    fp.write(struct.pack(">I", zlib.crc32(chunkType + data)))
+
+
+def streamImage(bitmap, path, imageFormat, pngCompression=6, rows=512):
+    """
+    write an RGB bitmap to path in imageFormat a band of rows at a time
+    only one band is held in memory, so a memory-mapped bitmap is never copied as a whole
+    """
+    height, width = bitmap.shape[0], bitmap.shape[1]
+    with open(path, "wb") as fp:
+        if imageFormat == "bmp":
+            # 24-bit bottom-up BGR rows, each padded to 4 bytes
+            rowBytes = (width * 3 + 3) // 4 * 4
+            fp.write(struct.pack("<2sIHHI", b"BM", 54 + rowBytes * height, 0, 0, 54))
+            fp.write(struct.pack("<IiiHHIIiiII", 40, width, height, 1, 24, 0, rowBytes * height, 2835, 2835, 0, 0))
+            for band in iterateRows(bitmap, rows, reverse=True):
+                padded = np.zeros((band.shape[0], rowBytes), np.uint8)
+                padded[:, :width * 3] = band[:, :, ::-1].reshape(band.shape[0], -1)
+                fp.write(padded.tobytes())
+        elif imageFormat == "png":
+            fp.write(b"\x89PNG\r\n\x1a\n")
+            writePngChunk(fp, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            compressor = zlib.compressobj(pngCompression)
+            for band in iterateRows(bitmap, rows):
+                # every row starts with filter type 0
+                filtered = np.zeros((band.shape[0], width * 3 + 1), np.uint8)
+                filtered[:, 1:] = band.reshape(band.shape[0], -1)
+                data = compressor.compress(filtered.tobytes())
+                if data:
+                    writePngChunk(fp, b"IDAT", data)
+            writePngChunk(fp, b"IDAT", compressor.flush())
+            writePngChunk(fp, b"IEND", b"")
+        elif imageFormat == "npy":
+            np.lib.format.write_array_header_1_0(fp, {"descr": np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+                                                      "fortran_order": False, "shape": (height, width, 3)})
+            for band in iterateRows(bitmap, rows):
+                fp.write(band.tobytes())
+        elif imageFormat == "ppm":
+            fp.write(b"P6\n%d %d\n255\n" % (width, height))
+            for band in iterateRows(bitmap, rows):
+                fp.write(band.tobytes())
+        else:
+            raise ValueError("unknown image format " + imageFormat)
+
+
+# bitmaps attached by a render worker process, by their locations
+attachedBitmaps = {}
+
+
+def attachBitmap(location):
+    """ return the bitmap at location, which is ("file", path, shape) or ("shm", name, shape) """
+    if location not in attachedBitmaps:
+        # a worker only paints the latest bitmap of its canvas
+        for handle, _ in attachedBitmaps.values():
+            if handle is not None:
+                handle.close()
+        attachedBitmaps.clear()
+        kind, name, shape = location
+        if kind == "file":
+            attachedBitmaps[location] = (None, np.memmap(name, np.uint8, "r+", shape=shape))
+        else:
+            handle = shared_memory.SharedMemory(name=name)
+            attachedBitmaps[location] = (handle, np.ndarray(shape, np.uint8, buffer=handle.buf))
+    return attachedBitmaps[location][1]
+
+
+def paintTiles(location, tiles):
+    """ in a render worker, clear each (region, graphics) tile of the bitmap at location and draw its graphics """
+    bitmap = attachBitmap(location)
+    for (x0, y0, x1, y1), graphics in tiles:
+        bitmap[y0:y1, x0:x1] = 0
+        for graphic in graphics:
+            graphic.paint(bitmap, (x0, y0, x1, y1))
+        if location[0] == "file":
+            releaseRows(bitmap, y0, y1)
+
+
+class ImageWriter:
+    """
+    write images on a pool of background threads
+    at most maxPending snapshots wait to be written, submit blocks until one finishes when there are more
+    writes to the same path are done in the order they are submitted, so the last one is left on disk
+    an error of any write is raised by the next submit or close
+    """
+
+    def __init__(self, workers, maxPending=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(maxPending if maxPending is not None else 2 * workers)
+        self.futures = set()
+        # the last write submitted for each path, while it isn't done
+        self.lastWrites = {}
+        self.lock = threading.Lock()
+        self.error = None
+
+    def submit(self, bitmap, path, imageFormat, pngCompression=6, write=writeImage):
+        """ queue bitmap to be written by write, bitmap must not be modified afterwards """
+        self.raiseError()
+        self.slots.acquire()
+        with self.lock:
+            previous = self.lastWrites.get(path)
+            future = self.pool.submit(writeAfter, previous, write, bitmap, path, imageFormat, pngCompression)
+            self.futures.add(future)
+            self.lastWrites[path] = future
+        future.add_done_callback(lambda done: self.onDone(done, path))
+
+    def onDone(self, future, path):
+        with self.lock:
+            self.futures.discard(future)
+            if self.lastWrites.get(path) is future:
+                del self.lastWrites[path]
+            if future.exception() is not None and self.error is None:
+                self.error = future.exception()
+        self.slots.release()
+
+    def raiseError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """ wait for all queued images and stop the threads """
+        self.pool.shutdown(wait=True)
+        self.raiseError()
+
+
+def writeAfter(previous, write, *args):
+    """
+    call write once the future previous is done, if it isn't None
+    previous was submitted to the same pool earlier, so it has been picked up by another thread and can't wait for us
+    """
+    if previous is not None:
+        wait([previous])
+    write(*args)
+
+
+class Profiler:
+    """
+    record wall time of commands, graphics painted, updates and image encoding, and count pixels graphics produce
+    against pixels written inside the canvas
+    every measurement is kept as a chrome trace event, and added to the totals of its category and name
+    """
+
+    def __init__(self):
+        self.begin = time.perf_counter()
+        self.events = []
+        self.totals = {}
+        self.pixelsProduced = 0
+        self.pixelsWritten = 0
+        # writer threads measure encoding at the same time
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, category, name, **args):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(category, name, begin, time.perf_counter() - begin, args)
+
+    def wrap(self, category, name, function):
+        """ return function measuring every call of it """
+        def measured(*args, **kwargs):
+            with self.measure(category, name):
+                return function(*args, **kwargs)
+        return measured
+
+    def record(self, category, name, begin, seconds, args):
+        event = {"name": name, "cat": category, "ph": "X", "ts": (begin - self.begin) * 1e6, "dur": seconds * 1e6,
+                 "pid": os.getpid(), "tid": threading.get_ident(), "args": args}
+        with self.lock:
+            self.events.append(event)
+            total = self.totals.setdefault(category, {}).setdefault(name, {"count": 0, "seconds": 0.0})
+            total["count"] += 1
+            total["seconds"] += seconds
+
+    def countPixels(self, produced, written):
+        with self.lock:
+            self.pixelsProduced += produced
+            self.pixelsWritten += written
+
+    def getSummary(self):
+        """ return totals of every category and name, with pixel counts """
+        with self.lock:
+            summary = {category: {name: dict(total) for name, total in names.items()}
+                       for category, names in self.totals.items()}
+            summary["pixels"] = {"produced": self.pixelsProduced, "written": self.pixelsWritten}
+        summary["seconds"] = time.perf_counter() - self.begin
+        return summary
+
+    def write(self, path, traceFormat="json"):
+        """ write the summary as json, or all events as a chrome trace to be opened in chrome://tracing """
+        if traceFormat == "chrome":
+            with self.lock:
+                events = list(self.events)
+            content = {"traceEvents": events, "displayTimeUnit": "ms", "otherData": self.getSummary()}
+        else:
+            content = self.getSummary()
+        with open(path, "w") as fp:
+            json.dump(content, fp, indent=1)
+
+
+def measure(profiler, category, name, **args):
+    """ measure a block by profiler, doing nothing if it is None """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.measure(category, name, **args)
+
+
+class CheckpointCache:
+    """
+    checkpoints of canvas state on disk, each one is a snapshot in a directory named by its key
+    the key after i commands hashes the key after i - 1 commands with the i-th one, starting from a hash of options,
+    so a checkpoint is found by any script sharing the commands before it
+    a checkpoint becomes usable once commit has recorded sizes and modification times of the images saved before it,
+    and it is only loaded while those files are unchanged, since resuming skips saving them
+    snapshots loaded before it are recorded the same way, since the commands alone don't tell what they held
+    the least recently used checkpoints are removed while the cache is larger than maxBytes
+    """
+
+    def __init__(self, directory, maxBytes, options=""):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.seed = hashlib.blake2b(options.encode(), digest_size=20).digest()
+        # (key, saved paths) of checkpoints stored but not yet committed
+        self.pending = []
+        os.makedirs(directory, exist_ok=True)
+
+    def getKeys(self, commands):
+        """ return keys after 0, 1, ..., len(commands) commands """
+        digest = self.seed
+        keys = [digest.hex()]
+        for command in commands:
+            digest = hashlib.blake2b(digest + command.strip().encode(), digest_size=20).digest()
+            keys.append(digest.hex())
+        return keys
+
+    def getStoredKeys(self):
+        """ return the set of keys with a checkpoint, usable or not """
+        return {entry.name for entry in os.scandir(self.directory) if entry.is_dir() and not entry.name.startswith(".")}
+
+    def load(self, key):
+        """
+        return (snapshot read by readSnapshot, saved paths, loaded paths) of a usable checkpoint,
+        None if there is none
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, "files.json"), "r") as fp:
+                files = json.load(fp)
+            for filePath, size, modified in files["saved"] + files["loaded"]:
+                status = os.stat(filePath)
+                if status.st_size != size or status.st_mtime_ns != modified:
+                    return None
+            snapshot = readSnapshot(os.path.join(path, "snapshot"))
+            # mark it as used
+            os.utime(os.path.join(path, "files.json"))
+        except (OSError, ValueError, KeyError, TypeError):
+            # missing, not committed, evicted meanwhile or broken
+            return None
+        return snapshot, [filePath for filePath, _, _ in files["saved"]], \
+            [filePath for filePath, _, _ in files["loaded"]]
+
+    def store(self, key, canvas):
+        """ write a checkpoint of canvas, it is put in place at once so no other process sees it half written """
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(path):
+            temporary = tempfile.mkdtemp(dir=self.directory, prefix=".")
+            writeSnapshot(canvas, os.path.join(temporary, "snapshot"))
+            try:
+                os.rename(temporary, path)
+            except OSError:
+                # another process stored it first
+                shutil.rmtree(temporary, ignore_errors=True)
+        self.pending.append((key, list(canvas.savedPaths), list(canvas.loadedPaths)))
+
+    def commit(self, savedPaths):
+        """
+        record the images saved and snapshots loaded before each pending checkpoint, making them usable,
+        then keep cache size
+        savedPaths are all paths saved by the run, in order, a checkpoint is left unusable if a file recorded
+        for it was saved again after it, since the file on disk no longer is the one saved before the checkpoint
+        """
+        for key, savedBefore, loadedPaths in self.pending:
+            if set(savedPaths[len(savedBefore):]) & set(savedBefore + loadedPaths):
+                continue
+            files = {}
+            for kind, paths in (("saved", savedBefore), ("loaded", loadedPaths)):
+                files[kind] = []
+                for filePath in paths:
+                    status = os.stat(filePath)
+                    files[kind].append((filePath, status.st_size, status.st_mtime_ns))
+            try:
+                with open(os.path.join(self.directory, key, "files.json"), "w") as fp:
+                    json.dump(files, fp)
+            except OSError:
+                # evicted by another process
+                pass
+        self.pending = []
+        self.evict()
+
+    def evict(self):
+        """ remove the least recently used checkpoints until the cache fits maxBytes """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            size = 0
+            for root, _, names in os.walk(entry.path):
+                size += sum(os.path.getsize(os.path.join(root, name)) for name in names)
+            marker = os.path.join(entry.path, "files.json")
+            used = os.path.getmtime(marker) if os.path.exists(marker) else entry.stat().st_mtime
+            entries.append((used, size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def openScript(inputPath):
+    """
+    open a command script as text, - is standard input, .gz and .zst files are decompressed as they are read
+    .zst needs the zstandard package
+    """
+    if inputPath == "-":
+        # standard input is left open
+        return contextlib.nullcontext(sys.stdin)
+    if inputPath.endswith(".gz"):
+        return gzip.open(inputPath, 'rt')
+    if inputPath.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("reading .zst scripts needs the zstandard package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(inputPath, 'rb'), closefd=True))
+    return open(inputPath, 'r')
+
+
+def renderScript(inputPath, outputDir, stream=False, **options):
+    """
+    render a command script into outputDir, options go to CommandParser, return seconds it took
+    with stream, commands are parsed while earlier ones are rendered instead of being compiled first
+    """
+    begin = time.perf_counter()
+    os.makedirs(outputDir, exist_ok=True)
+    parser = CommandParser(outputDir, **options)
+    try:
+        with openScript(inputPath) as fp:
+            if stream:
+                parser.stream(fp)
+            else:
+                parser.run(fp)
+    finally:
+        parser.close()
+    return time.perf_counter() - begin
+
+
+def readManifest(manifestPath):
+    """
+    read a manifest listing one "input_path output_dir" pair per line, # starts a comment line
+    relative paths are relative to the manifest
+    """
+    baseDir = os.path.dirname(os.path.abspath(manifestPath))
+    jobs = []
+    with open(manifestPath, 'r') as fp:
+        for line in fp:
+            words = line.split()
+            if not words or words[0].startswith("#"):
+                continue
+            if len(words) != 2:
+                raise ValueError("bad manifest line: " + line.strip())
+            jobs.append((os.path.join(baseDir, words[0]), os.path.join(baseDir, words[1])))
+    return jobs
+
+
+def renderBatch(jobs, processes, **options):
+    """
+    render (input_path, output_dir) jobs across a process pool, printing status and time of each one
+    a failed script doesn't stop the others, return the number of failed ones
+    """
+    failed = 0
+    begin = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(renderScript, inputPath, outputDir, **options): inputPath
+                   for inputPath, outputDir in jobs}
+        for future in as_completed(futures):
+            try:
+                print("ok      %8.3fs  %s" % (future.result(), futures[future]), flush=True)
+            except Exception as e:
+                failed += 1
+                print("FAILED  %9s  %s: %s: %s" % ("", futures[future], type(e).__name__, e), flush=True)
+    print("%d scripts, %d failed, %.3fs" % (len(jobs), failed, time.perf_counter() - begin), flush=True)
+    return failed
+
+
+def parseArguments(argv):
+    argParser = argparse.ArgumentParser(
+        description="render command scripts, with several input paths each one is rendered into a subdirectory "
+                    "of output_dir named after it")
+    argParser.add_argument("paths", nargs="*", metavar="path",
+                           help="input_path [input_path ...] output_dir, an input path may be - for standard input "
+                                "or a .gz or .zst compressed script")
+    argParser.add_argument("--manifest", help="file listing one \"input_path output_dir\" pair per line")
+    argParser.add_argument("-j", "--jobs", type=int, default=None,
+                           help="number of worker processes for batch rendering, all cores by default")
+    argParser.add_argument("--format", choices=imageFormats, default="bmp", help="format of saved images")
+    argParser.add_argument("--png-compression", type=int, choices=range(10), default=6, metavar="0-9",
+                           help="zlib compression level of png images")
+    argParser.add_argument("--writers", type=int, default=2,
+                           help="number of background threads writing images, 0 writes them synchronously")
+    argParser.add_argument("--render-jobs", type=int, default=0,
+                           help="number of worker processes painting large regions of a canvas in tiles, "
+                                "0 paints in this process")
+    argParser.add_argument("--memmap-dir", default=None,
+                           help="back the canvas with a memory-mapped temporary file in this directory, "
+                                "for canvases too large to keep in memory")
+    argParser.add_argument("--curve-tolerance", type=float, default=0.5,
+                           help="farthest distance in pixels between a curve and the polyline it is drawn as")
+    argParser.add_argument("--cache-dir", default=None,
+                           help="keep checkpoints of canvas state in this directory, a script run again resumes from "
+                                "the last checkpoint its commands still lead to")
+    argParser.add_argument("--cache-size", type=int, default=1024,
+                           help="megabytes of checkpoints kept, the least recently used ones are removed beyond it")
+    argParser.add_argument("--checkpoint-every", type=int, default=1000,
+                           help="number of commands between checkpoints, one is also made after the last command")
+    argParser.add_argument("--stream", action="store_true",
+                           help="parse commands on another thread while rendering earlier ones, in bounded memory, "
+                                "instead of compiling the whole script first")
+    argParser.add_argument("--profile", default=None,
+                           help="measure commands, graphics, updates and encoding of a script and write them here")
+    argParser.add_argument("--profile-format", choices=("json", "chrome"), default="json",
+                           help="write a json summary, or a chrome trace of every measurement")
+    args = argParser.parse_args(argv)
+    if not args.curve_tolerance > 0:
+        argParser.error("curve tolerance must be positive")
+    if args.checkpoint_every < 1:
+        argParser.error("checkpoint interval must be positive")
+
+    jobs = readManifest(args.manifest) if args.manifest is not None else []
+    if len(args.paths) == 1 or (not jobs and not args.paths):
+        argParser.error("expect input paths followed by an output directory")
+    if len(args.paths) == 2:
+        jobs.append((args.paths[0], args.paths[1]))
+    elif args.paths:
+        outputDir = args.paths[-1]
+        for inputPath in args.paths[:-1]:
+            name = os.path.splitext(os.path.basename(inputPath))[0]
+            jobs.append((inputPath, os.path.join(outputDir, name)))
+    if args.jobs is not None and args.jobs < 1:
+        argParser.error("jobs must be positive")
+    # scripts rendered into the same directory would overwrite each other's images
+    outputDirs = {}
+    for inputPath, outputDir in jobs:
+        key = os.path.abspath(outputDir)
+        if key in outputDirs:
+            argParser.error("{} and {} would both be rendered into {}, rename one or list them in a manifest"
+                            .format(outputDirs[key], inputPath, outputDir))
+        outputDirs[key] = inputPath
+    if args.profile is not None and (len(jobs) != 1 or args.jobs is not None):
+        argParser.error("--profile works on a single script")
+    if any(inputPath == "-" for inputPath, _ in jobs) and (len(jobs) != 1 or args.jobs is not None):
+        argParser.error("standard input works as a single script")
+    if args.stream and args.cache_dir is not None:
+        argParser.error("--stream can't resume from checkpoints, which need the whole script")
+    return args, jobs
 
 
 if __name__ == '__main__':
-    argInputFile = sys.argv[1]
-    argOutputDir = sys.argv[2]
-    os.makedirs(argOutputDir, exist_ok=True)
-    parser = CommandParser(argOutputDir)
-
-    with open(argInputFile, 'r') as fp:
-        inputLine = fp.readline()
-        while inputLine:
-            parser.interpret(inputLine)
-            inputLine = fp.readline()
+    argArgs, argJobs = parseArguments(sys.argv[1:])
+    argOptions = dict(imageFormat=argArgs.format, pngCompression=argArgs.png_compression, writers=argArgs.writers,
+                      mappedDir=argArgs.memmap_dir, renderJobs=argArgs.render_jobs,
+                      curveTolerance=argArgs.curve_tolerance, cacheDir=argArgs.cache_dir,
+                      cacheSize=argArgs.cache_size << 20, checkpointInterval=argArgs.checkpoint_every,
+                      stream=argArgs.stream)
+    if argArgs.profile is not None:
+        argProfiler = Profiler()
+        try:
+            renderScript(*argJobs[0], profiler=argProfiler, **argOptions)
+        finally:
+            argProfiler.write(argArgs.profile, argArgs.profile_format)
+    elif len(argJobs) == 1 and argArgs.jobs is None:
+        renderScript(*argJobs[0], **argOptions)
+    else:
+        sys.exit(1 if renderBatch(argJobs, argArgs.jobs, **argOptions) else 0)
@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# only the standard library is imported, so the client starts fast, rendering is left to cg_server.py
+defaultSocket = os.path.join(tempfile.gettempdir(), "cg-drawer.sock")
+
+
+def readExactly(fp, size):
+    content = fp.read(size)
+    if len(content) != size:
+        raise ConnectionError("connection closed in the middle of a response")
+    return content
+
+
+def requestRender(socketPath, inputPath, outputDir, options, fetch=False):
+    """
+    send a command script to the render server and wait for it to be rendered
+    the server saves images into outputDir, or with fetch they are sent back and written into outputDir here
+    return paths of saved images and seconds the server took, raise RuntimeError if rendering failed
+    """
+    header = {"options": options, "images": fetch}
+    if not fetch:
+        header["outputDir"] = os.path.abspath(outputDir)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socketPath)
+        connection.sendall((json.dumps(header) + "\n").encode())
+        with (sys.stdin.buffer if inputPath == "-" else open(inputPath, "rb")) as fp:
+            for chunk in iter(lambda: fp.read(1 << 16), b""):
+                connection.sendall(chunk)
+        connection.shutdown(socket.SHUT_WR)
+
+        with connection.makefile("rb") as response:
+            result = json.loads(response.readline())
+            if result["status"] != "ok":
+                raise RuntimeError(result["error"])
+            if not fetch:
+                return result["paths"], result["seconds"]
+            os.makedirs(outputDir, exist_ok=True)
+            paths = []
+            for file in result["files"]:
+                path = os.path.join(outputDir, os.path.basename(file["name"]))
+                with open(path, "wb") as fp:
+                    fp.write(readExactly(response, file["size"]))
+                paths.append(path)
+            return paths, result["seconds"]
+
+
+def parseArguments(argv):
+    argParser = argparse.ArgumentParser(
+        description="render a command script on a running cg_server.py, like cg_cli.py input_path output_dir")
+    argParser.add_argument("input_path", help="command script, - reads it from standard input")
+    argParser.add_argument("output_dir")
+    argParser.add_argument("--socket", default=defaultSocket, help="unix socket the server listens on")
+    argParser.add_argument("--fetch", action="store_true",
+                           help="get images back over the socket instead of letting the server write output_dir")
+    argParser.add_argument("--format", default="bmp", help="format of saved images")
+    argParser.add_argument("--png-compression", type=int, choices=range(10), default=6, metavar="0-9",
+                           help="zlib compression level of png images")
+    argParser.add_argument("--curve-tolerance", type=float, default=0.5,
+                           help="farthest distance in pixels between a curve and the polyline it is drawn as")
+    args = argParser.parse_args(argv)
+    if args.input_path != "-" and not os.path.isfile(args.input_path):
+        argParser.error("no such input file: " + args.input_path)
+    return args
+
+
+if __name__ == '__main__':
+    argArgs = parseArguments(sys.argv[1:])
+    argOptions = dict(imageFormat=argArgs.format, pngCompression=argArgs.png_compression,
+                      curveTolerance=argArgs.curve_tolerance)
+    try:
+        argPaths, argSeconds = requestRender(argArgs.socket, argArgs.input_path, argArgs.output_dir, argOptions,
+                                             argArgs.fetch)
+    except (ConnectionRefusedError, FileNotFoundError) as argError:
+        print("cannot reach render server at {}: {}, is cg_server.py running?".format(argArgs.socket, argError),
+              file=sys.stderr)
+        sys.exit(2)
+    except RuntimeError as argError:
+        print("render failed: {}".format(argError), file=sys.stderr)
+        sys.exit(1)
+    for argPath in argPaths:
+        print(argPath)
@@ -139,6 +139,8 @@ class CanvasWidget(QWidget):
 
     def mousePressEvent(self, e):
         if not self.isGetting:
+            if e.button() == QtCore.Qt.MouseButton.LeftButton:
+                self.selectGraphicAt(e.x(), e.y())
             return
         if e.button() == QtCore.Qt.MouseButton.LeftButton:
             self.pointList.append((e.x(), e.y()))
@@ -151,6 +153,12 @@ class CanvasWidget(QWidget):
         elif e.button() == QtCore.Qt.MouseButton.RightButton:
             self.endGettingPoints()
 
+    def selectGraphicAt(self, x, y):
+        # gids of graphics drawn in gui are their rows in the table
+        gid = self.canvas.findGraphic(x, y)
+        if gid is not None:
+            self.tableWidget.selectRow(int(gid))
+
     def endGettingPoints(self):
         self.isGetting = False
         # notify waiting thread
@@ -0,0 +1,148 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cg_cli
+from cg_client import defaultSocket
+
+# CommandParser options a client may set, the rest stay under control of the server
+clientOptions = ("imageFormat", "pngCompression", "curveTolerance", "writers", "mappedDir")
+
+
+def renderCommands(commands, outputDir, options):
+    """
+    render commands on a new CommandParser in a worker process, so every client has a canvas of its own
+    return paths of saved images and snapshots, in order of first saving, and seconds it took
+    """
+    begin = time.perf_counter()
+    os.makedirs(outputDir, exist_ok=True)
+    parser = cg_cli.CommandParser(outputDir, **options)
+    try:
+        parser.run(commands)
+    finally:
+        parser.close()
+    return list(dict.fromkeys(parser.canvas.savedPaths)), time.perf_counter() - begin
+
+
+def warmUp():
+    """ nothing to do, submitted once to every worker so it is started before the first client comes """
+    return os.getpid()
+
+
+class RenderServer:
+    """
+    serve render requests on a unix domain socket, rendering them on a pool of worker processes
+    a request is a json header line, then command lines until the client shuts down its side of the connection
+    the header may hold outputDir to render into, options for CommandParser and images to get saved images back
+    the response is a json line with status, and paths and seconds or error, then with images the content of
+    every file listed in files one after another, files giving name and size of each one
+    """
+
+    def __init__(self, socketPath, workers):
+        self.socketPath = socketPath
+        self.workers = workers
+        self.pool = None
+
+    async def startPool(self):
+        """ start worker processes and wait until each one is ready """
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, warmUp) for _ in range(self.workers)])
+
+    async def restartPool(self, brokenPool):
+        """ replace a pool broken by a worker dying, unless another request has replaced it already """
+        if self.pool is not brokenPool:
+            return
+        brokenPool.shutdown(wait=False)
+        await self.startPool()
+
+    async def serve(self):
+        await self.startPool()
+        loop = asyncio.get_running_loop()
+        if os.path.exists(self.socketPath):
+            # left by a server which didn't stop cleanly
+            os.unlink(self.socketPath)
+        server = await asyncio.start_unix_server(self.handle, path=self.socketPath)
+        # stop cleanly on kill as well as on ctrl-c
+        for signalNumber in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signalNumber, asyncio.current_task().cancel)
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.pool.shutdown()
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
+
+    async def handle(self, reader, writer):
+        temporaryDir = None
+        try:
+            header = json.loads(await reader.readline())
+            commands = (await reader.read()).decode().splitlines()
+            options = {key: value for key, value in header.get("options", {}).items() if key in clientOptions}
+            outputDir = header.get("outputDir")
+            if outputDir is None:
+                if not header.get("images"):
+                    raise ValueError("expect outputDir or images in request")
+                temporaryDir = outputDir = tempfile.mkdtemp(prefix="cg-drawer-")
+
+            pool = self.pool
+            try:
+                paths, seconds = await asyncio.get_running_loop().run_in_executor(
+                    pool, renderCommands, commands, outputDir, options)
+            except BrokenProcessPool:
+                # a worker was killed, e.g. out of memory, later requests get a new pool
+                await self.restartPool(pool)
+                raise
+            response = {"status": "ok", "paths": paths, "seconds": seconds}
+            contents = []
+            if header.get("images"):
+                # snapshots are directories, only files are sent back
+                paths = [path for path in paths if os.path.isfile(path)]
+                for path in paths:
+                    with open(path, "rb") as fp:
+                        contents.append(fp.read())
+                response["files"] = [{"name": os.path.basename(path), "size": len(content)}
+                                     for path, content in zip(paths, contents)]
+            writer.write((json.dumps(response) + "\n").encode())
+            for content in contents:
+                writer.write(content)
+        except Exception as error:
+            writer.write((json.dumps({"status": "error", "error": "{}: {}".format(type(error).__name__, error)})
+                          + "\n").encode())
+        finally:
+            if temporaryDir is not None:
+                shutil.rmtree(temporaryDir, ignore_errors=True)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def parseArguments(argv):
+    argParser = argparse.ArgumentParser(
+        description="keep renderers warm and render command scripts sent by cg_client.py over a unix socket")
+    argParser.add_argument("--socket", default=defaultSocket, help="path of the unix socket to listen on")
+    argParser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                           help="number of worker processes rendering requests, all cores by default")
+    args = argParser.parse_args(argv)
+    if args.workers < 1:
+        argParser.error("workers must be positive")
+    return args
+
+
+if __name__ == '__main__':
+    argArgs = parseArguments(sys.argv[1:])
+    asyncio.run(RenderServer(argArgs.socket, argArgs.workers).serve())
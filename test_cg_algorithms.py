@@ -0,0 +1,84 @@
+import random
+
+import numpy as np
+
+import cg_algorithms as alg
+
+
+def walkBresenham(start, end):
+    """ the walking Bresenham lines were drawn by before rasterizing them in numpy """
+    swapped = abs(start[1] - end[1]) > abs(start[0] - end[0])
+    if swapped:
+        start, end = start[::-1], end[::-1]
+    flipped = (start[1] - end[1]) * (start[0] - end[0]) < 0
+    if flipped:
+        start, end = (start[0], -start[1]), (end[0], -end[1])
+    if start[0] > end[0]:
+        start, end = end, start
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    result = []
+    if dx == 0:
+        result = [(start[0], y) for y in range(start[1], end[1])]
+    elif dy == 0:
+        result = [(x, start[1]) for x in range(start[0], end[0])]
+    else:
+        x, y, decider = start[0], start[1], 2 * dy - dx
+        while x <= end[0]:
+            result.append((x, y))
+            x += 1
+            y += 1 if decider > 0 else 0
+            decider += 2 * dy - (2 * dx if decider > 0 else 0)
+    if flipped:
+        result = [(x, -y) for x, y in result]
+    if swapped:
+        result = [(y, x) for x, y in result]
+    return result
+
+
+def randomSegments(count, seed=0):
+    rng = random.Random(seed)
+    point = lambda: (rng.randint(-30, 130), rng.randint(-30, 130))
+    return [(point(), point()) for _ in range(count)]
+
+
+def testBresenhamMatchesWalkingVersion():
+    segments = randomSegments(500) + [((5, 5), (5, 5)), ((3, 7), (3, 20)), ((9, 2), (-4, 2))]
+    for start, end in segments:
+        pixels = alg.rasterizeLinesByBresenham([start], [end])
+        assert sorted(map(tuple, pixels.tolist())) == sorted(walkBresenham(start, end))
+
+
+def testBatchedLinesMatchOneByOne():
+    viewport = (0, 0, 100, 100)
+    lines = []
+    for i, (start, end) in enumerate(randomSegments(300, seed=1)):
+        line = alg.Line("DDA" if i % 2 else "Bresenham", (255, 0, 0), start, end)
+        line.viewport = viewport
+        lines.append(line)
+    alg.rasterizeLines(lines)
+    for line in lines:
+        batched = line.raster
+        line.invalidate()
+        assert np.array_equal(batched, line.rasterize())
+
+
+def distancesToPolyline(points, vertices):
+    starts, chords = vertices[:-1], vertices[1:] - vertices[:-1]
+    offsets = points[:, None] - starts
+    ts = np.clip((offsets * chords).sum(axis=-1) / np.maximum((chords ** 2).sum(axis=-1), 1e-12), 0, 1)
+    nearest = offsets - ts[..., None] * chords
+    return np.hypot(nearest[..., 0], nearest[..., 1]).min(axis=1)
+
+
+def testFlattenedCurvesStayWithinTolerance():
+    # sampling between the checked eighths may still find the curve a little farther
+    rng, tolerance = random.Random(2), 0.5
+    for i in range(200):
+        points = np.array([(rng.randint(0, 300), rng.randint(0, 300)) for _ in range(rng.randint(4, 10))], np.float64)
+        if i % 2:
+            evaluate, low, high = (lambda us: alg.evaluateBezier(points, us)), 0, 1
+        else:
+            evaluate, low, high = (lambda us: alg.evaluateBSpline(points, 3, us)), 3, len(points)
+        us = np.linspace(low, high, 4 * (len(points) - 1) + 1)
+        vertices = alg.flattenCurve(evaluate, us, evaluate(us), tolerance)
+        assert distancesToPolyline(evaluate(np.linspace(low, high, 4001)), vertices).max() < tolerance + 0.05
@@ -0,0 +1,101 @@
+import numpy as np
+from PIL import Image
+
+import cg_cli
+
+
+def renderCommands(outputDir, commands, **options):
+    outputDir.mkdir()
+    parser = cg_cli.CommandParser(str(outputDir), **options)
+    try:
+        for command in commands:
+            parser.interpret(command)
+    finally:
+        parser.close()
+
+
+def readImage(path):
+    return np.array(Image.open(str(path)))
+
+
+def testTranslateAfterScaleIsRigid(tmp_path):
+    # scaling puts points on .5, an integral translate must still move the pixels rigidly,
+    # whether the raster is shifted from an earlier save or drawn again
+    commands = ["resetCanvas 60 60", "setColor 255 0 0",
+                "drawLine a 21 21 41 41 Bresenham", "drawEllipse e 11 11 30 24",
+                "scale a 0 0 0.5", "scale e 0 0 0.5"]
+    moves = ["translate a 1 1", "translate e 1 1", "saveCanvas s2"]
+    renderCommands(tmp_path / "saved", commands + ["saveCanvas s1"] + moves)
+    renderCommands(tmp_path / "direct", commands + moves)
+
+    before = readImage(tmp_path / "saved" / "s1.bmp")
+    after = readImage(tmp_path / "saved" / "s2.bmp")
+    assert (after == readImage(tmp_path / "direct" / "s2.bmp")).all()
+    assert (after[1:, 1:] == before[:-1, :-1]).all()
+
+
+def testLaterSaveToSamePathWins(tmp_path):
+    # writer threads must not let the first image of a path overwrite the second one
+    commands = ["resetCanvas 50 50", "setColor 255 0 0", "drawLine l 0 0 40 40 Bresenham",
+                "saveCanvas a", "translate l 5 0", "saveCanvas a"]
+    renderCommands(tmp_path / "sync", commands, writers=0)
+    for i in range(5):
+        renderCommands(tmp_path / str(i), commands, writers=4)
+        assert (readImage(tmp_path / str(i) / "a.bmp") == readImage(tmp_path / "sync" / "a.bmp")).all()
+    assert readImage(tmp_path / "sync" / "a.bmp")[0, 5].tolist() == [255, 0, 0]
+
+
+def runCommands(outputDir, commands, **options):
+    parser = cg_cli.CommandParser(str(outputDir), **options)
+    try:
+        parser.run(commands)
+    finally:
+        parser.close()
+
+
+def testCheckpointIgnoresImageSavedAgainAfterIt(tmp_path):
+    # v1 saves a again after the checkpoint, v2 must not resume from it and keep the a of v1
+    prefix = ["resetCanvas 50 50", "setColor 255 0 0", "drawLine l 0 0 40 40 Bresenham", "saveCanvas a"]
+    v1 = prefix + ["translate l 5 0", "saveCanvas a"]
+    v2 = prefix + ["drawLine m 0 40 40 0 Bresenham", "saveCanvas b"]
+    options = dict(cacheDir=str(tmp_path / "cache"), checkpointInterval=4)
+    (tmp_path / "cached").mkdir()
+    runCommands(tmp_path / "cached", v1, **options)
+    runCommands(tmp_path / "cached", v2, **options)
+    renderCommands(tmp_path / "fresh", v2)
+    for name in ("a.bmp", "b.bmp"):
+        assert (readImage(tmp_path / "cached" / name) == readImage(tmp_path / "fresh" / name)).all()
+
+
+def runAndInterpret(tmp_path, commands):
+    """ return the errors of running and of interpreting commands, None for one which didn't raise """
+    errors = []
+    tmp_path.mkdir()
+    (tmp_path / "run").mkdir()
+    for render, outputDir in ((runCommands, tmp_path / "run"), (renderCommands, tmp_path / "interpret")):
+        try:
+            render(outputDir, commands)
+            errors.append(None)
+        except Exception as error:
+            errors.append(error)
+    return errors
+
+
+def testDeadOperationsRaiseLikeInterpreted(tmp_path):
+    # operations left out as dead, after the last save or on a gid drawn again before it, must still fail
+    prefix = ["resetCanvas 50 50", "setColor 255 0 0", "drawEllipse e 10 10 30 20", "drawPolygon p 1 1 9 1 5 9 DDA"]
+    scripts = [
+        prefix + ["saveCanvas a", "rotate e 0 0 30"],
+        prefix + ["saveCanvas a", "clip p 0 0 5 5 Liang-Barsky"],
+        prefix + ["saveCanvas a", "translate q 1 1"],
+        prefix + ["drawEllipse l 1 1 9 9", "rotate l 0 0 30", "drawLine l 0 0 9 9 DDA", "saveCanvas a"],
+        prefix + ["drawLine e 0 0 9 9 DDA", "clip e 0 0 5 5 Cohen-Sutherland", "drawEllipse e 1 1 9 9",
+                  "rotate e 0 0 30", "saveCanvas a"],
+    ]
+    for i, commands in enumerate(scripts):
+        ran, interpreted = runAndInterpret(tmp_path / str(i), commands)
+        assert ran is not None and type(ran) is type(interpreted) and ran.args == interpreted.args
+
+    valid = prefix + ["drawLine e 0 0 9 9 DDA", "rotate e 0 0 30", "clip e 0 0 5 5 Liang-Barsky",
+                      "drawEllipse e 1 1 9 9", "saveCanvas a", "scale p 0 0 2"]
+    assert runAndInterpret(tmp_path / "valid", valid) == [None, None]